@@ -1,6 +1,6 @@
 import logging
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format="%(asctime)s %(levelname)s [%(filename)s %(name)s %(funcName)s (%(lineno)d)]: %(message)s",
 )
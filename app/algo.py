@@ -1,8 +1,12 @@
-from collections import defaultdict
+import logging
+from collections import defaultdict, Counter
+from typing import Optional
 
+import numpy
 import pandas as pd
 
 from .encode import *
+from .plan import OTHER_LEVEL
 import pandas
 
 
@@ -11,49 +15,166 @@ def set_as_categorical(table: pandas.DataFrame, column_label: str):
     return table
 
 
-def drop_rows_with_introduced_na_values(original_table: pandas.DataFrame, encoded_table: pandas.DataFrame):
-    # get labels that changed
-    original_labels = set(original_table.columns.values)
-    new_labels = set(encoded_table.columns.values)
-    diff_labels = new_labels.difference(original_labels)
-
-    isna = encoded_table.isna()  # all NA values
-    relevant_isna = isna[diff_labels].copy()  # NA values in newly introduced columns
-
-    # ignore NA values that already were an NA in the original data
-    for name, series in relevant_isna.iteritems():
-        original_col_name = ''.join(name.split('=')[:-1])
-        original_isna = original_table[original_col_name].isna()
-
-        for i, orig in enumerate(original_isna):
-            if orig:
-                relevant_isna[name][i] = False
-
-    relevant_rows_with_new_na_values = relevant_isna.any(axis=1)
-    drop_indices = encoded_table.index[relevant_rows_with_new_na_values]
-    return encoded_table.drop(drop_indices)
+def drop_rows_with_unknown_categories(table: pandas.DataFrame, levels: Dict[str, Set[Union[str, int]]],
+                                      workers: int = 1, ordinal: bool = False):
+    # decide on the original table which rows would introduce NA values, so they are never encoded.
+    # Returns the filtered table and the codes of the remaining rows to pass on to encode_categorical.
+    # The one-hot encoding passes columns with a single level through, so their unknown values are kept, the ordinal
+    # encoding replaces them by missing values
+    plan = compile_plan(levels)
+    codes = get_codes(table, plan, workers=workers)
+    passthrough = [] if ordinal else [name for name in codes if plan.widths[name] == 0]
+    valid_rows = get_valid_rows(table, codes, ignore=passthrough)
+    if valid_rows.all():
+        return table, codes
 
+    return table[valid_rows], {name: column_codes[valid_rows] for name, column_codes in codes.items()}
 
-def get_categories(table: pandas.DataFrame):
-    discrete_columns = get_columns_to_encode(table)
 
-    summary = {}
+def drop_rows_with_introduced_na_values(original_table: pandas.DataFrame, encoded_table: pandas.DataFrame,
+                                        valid_rows: Optional[numpy.ndarray] = None):
+    # the validity mask returned by encode_categorical already marks the rows with unknown categories
+    if valid_rows is not None:
+        return encoded_table[valid_rows]
 
-    for col_name in discrete_columns:
-        series = table[col_name]
-        categories: pandas.Index = pandas.Categorical(series).categories
-        summary[col_name] = set(categories.array)
-
-    return summary
+    # labels that were introduced by the encoding
+    original_labels = set(original_table.columns.values)
+    new_labels = [label for label in encoded_table.columns.values if label not in original_labels]
+
+    # NA values in newly introduced columns, ignoring NA values that already were an NA in the original data
+    introduced_na = numpy.zeros(len(encoded_table), dtype=bool)
+    for name in new_labels:
+        original_col_name = name.rsplit('=', 1)[0]
+        introduced_na |= encoded_table[name].isna().to_numpy() & original_table[original_col_name].notna().to_numpy()
+
+    return encoded_table[~introduced_na]
+
+
+class CategoryDiscovery:
+    # Collects the categories of the columns to encode table by table, e.g. chunk by chunk, from the unique values of
+    # every chunk, so memory grows with the number of distinct values and not with the number of rows.
+    # With counts=True the number of occurrences of every category is collected instead.
+    # A column with more than max_cardinality categories is no longer tracked: its summary keeps max_cardinality + 1
+    # categories, which is enough for the coordinator to tell that the column exceeds the cap
+
+    def __init__(self, max_cardinality: Optional[int] = None, counts: bool = False):
+        self.max_cardinality = max_cardinality
+        self.counts = counts
+        self.summary: Dict[str, Union[Set, Counter]] = {}
+        self.exceeded: Set[str] = set()
+
+    def update(self, table: pandas.DataFrame) -> Set[str]:
+        # returns the columns of the table that are summarized
+        columns = get_columns_to_encode(table)
+        for col_name in columns:
+            if col_name in self.exceeded:
+                continue
+            series = table[col_name]
+            if self.counts:
+                counts = series.value_counts(dropna=True)
+                self.summary.setdefault(col_name, Counter()).update(
+                    {value: int(count) for value, count in counts.items() if count > 0})
+            else:
+                if is_categorical_dtype(series.dtype):
+                    # all categories of the column, also the ones that do not occur
+                    values = series.cat.categories.array
+                else:
+                    values = [value for value in pandas.unique(series.to_numpy()) if not pandas.isna(value)]
+                self.summary.setdefault(col_name, set()).update(values)
+
+            if self.max_cardinality is not None and len(self.summary[col_name]) > self.max_cardinality:
+                logging.info(f"Column {col_name!r} has more than {self.max_cardinality} categories, "
+                             f"stop collecting its categories")
+                self.exceeded.add(col_name)
+                self.summary[col_name] = self._truncate(self.summary[col_name], self.max_cardinality + 1)
+        return columns
+
+    def _truncate(self, values, limit: int):
+        if self.counts:
+            return Counter(top_counts(dict(values), limit))
+        return set(sorted(values, key=lambda value: (type(value).__name__, str(value)))[:limit])
+
+    def discard(self, col_name: str):
+        self.summary.pop(col_name, None)
+        self.exceeded.discard(col_name)
+
+    def distinct_counts(self) -> Dict[str, int]:
+        # number of distinct categories per column, a lower bound for the columns in self.exceeded
+        return {col_name: len(values) for col_name, values in self.summary.items()}
+
+    def result(self):
+        if self.counts:
+            return {col_name: dict(counts) for col_name, counts in self.summary.items()}
+        return dict(self.summary)
+
+
+def get_categories(table: pandas.DataFrame, max_cardinality: Optional[int] = None):
+    discovery = CategoryDiscovery(max_cardinality)
+    discovery.update(table)
+    return discovery.result()
+
+
+def top_counts(counts: Dict[Union[str, int], int], limit: Optional[int] = None) -> Dict[Union[str, int], int]:
+    # the limit most frequent values, ties are broken by value so the result does not depend on the input order
+    if limit is None or len(counts) <= limit:
+        return counts
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], type(item[0]).__name__, str(item[0])))[:limit])
+
+
+def get_category_counts(table: pandas.DataFrame, limit: Optional[int] = None):
+    # like get_categories, but with the number of occurrences of every category. With a limit only the limit most
+    # frequent categories of every column are kept, the counts of the coordinator then are approximate
+    discovery = CategoryDiscovery(counts=True)
+    discovery.update(table)
+    return {col_name: top_counts(counts, limit) for col_name, counts in discovery.result().items()}
+
+
+class IncrementalCombiner:
+    # merges the local column summaries one at a time, so they can be folded in as they arrive.
+    # A summary maps every column either to its categories or, for capped columns, to the counts of its categories
+
+    def __init__(self):
+        self.categorical_levels = defaultdict(set)
+        self.counts = defaultdict(Counter)
+        self.n_summaries = 0
+
+    def add(self, local_data: Optional[Dict[str, Union[Set[Union[str, int]], Dict[Union[str, int], int]]]]):
+        self.n_summaries += 1
+        if local_data is None:
+            return
+        for column_name, column_values in local_data.items():
+            if isinstance(column_values, dict):
+                self.counts[column_name].update(column_values)
+            self.categorical_levels[column_name].update(column_values)
+
+    def discard(self, column_name: str):
+        self.categorical_levels.pop(column_name, None)
+        self.counts.pop(column_name, None)
+
+    def result(self, max_levels: Optional[int] = None, max_cardinality: Optional[int] = None):
+        # columns with more than max_levels categories keep the max_levels most frequent ones and get an
+        # OTHER_LEVEL bucket for the rest, columns with more than max_cardinality categories are not encoded
+        if max_levels is None and max_cardinality is None:
+            return self.categorical_levels
+
+        categorical_levels = {}
+        for column_name, column_values in self.categorical_levels.items():
+            if max_cardinality is not None and len(column_values) > max_cardinality:
+                logging.info(f"Skip column {column_name!r} with more than {max_cardinality} categories")
+                continue
+            if max_levels is not None and len(column_values) > max_levels:
+                counts = self.counts[column_name]
+                top = top_counts({value: counts.get(value, 0) for value in column_values}, max_levels)
+                logging.info(f"Keep the {max_levels} most frequent of {len(column_values)} categories of column "
+                             f"{column_name!r}")
+                column_values = set(top) | {OTHER_LEVEL}
+            categorical_levels[column_name] = column_values
+        return categorical_levels
 
 
 def combine(data: List[Dict[str, Set[Union[str, int]]]]):
-    categorical_levels = defaultdict(set)
-
-    print(data)
+    combiner = IncrementalCombiner()
     for local_data in data:
-        print(local_data)
-        for column_name, column_values in local_data.items():
-            categorical_levels[column_name].update(column_values)
+        combiner.add(local_data)
 
-    return categorical_levels
+    return combiner.result()
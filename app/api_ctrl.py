@@ -7,6 +7,18 @@ from .logic import logic
 
 api_server = Bottle()
 
+# upper bound of the wait parameter of the status route in seconds
+MAX_STATUS_WAIT = 60
+
+
+def parse_wait(value) -> float:
+    # seconds to wait clamped to [0, MAX_STATUS_WAIT], values that are not a number do not wait
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return min(max(wait, 0), MAX_STATUS_WAIT)
+
 
 # CAREFUL: Do NOT perform any computation-related tasks inside these methods, nor inside functions called from them!
 # Otherwise your app does not respond to calls made by the FeatureCloud system quickly enough
@@ -24,10 +36,18 @@ def ctrl_setup():
 
 @api_server.get("/status")
 def ctrl_status():
-    print(f"[API] GET /status (available={logic.status_available} finished={logic.status_finished})", flush=True)
+    # long polling: with ?wait=<seconds> the response is delayed until available or finished differ from the values
+    # given in the query (false by default) or the time is up
+    wait = parse_wait(request.query.get("wait", 0))
+    if wait > 0:
+        available, finished = logic.wait_for_status(request.query.get("available", "false") == "true",
+                                                    request.query.get("finished", "false") == "true", wait)
+    else:
+        available, finished = logic.status_available, logic.status_finished
+    print(f"[API] GET /status (available={available} finished={finished})", flush=True)
     return json.dumps({
-        "available": logic.status_available,
-        "finished": logic.status_finished,
+        "available": available,
+        "finished": finished,
     })
 
 
@@ -40,5 +60,7 @@ def ctrl_data_out():
 @api_server.route("/data", method="POST")
 def ctrl_data_in():
     print(f"[API] POST /data", flush=True)
+    # bottle keeps small bodies in memory and buffers large ones in a temporary file, handle_incoming copies them
+    # into a spooled file
     logic.handle_incoming(request.body)
     return ""
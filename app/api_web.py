@@ -1,4 +1,6 @@
-from bottle import Bottle
+import json
+
+from bottle import Bottle, response
 
 from .logic import logic
 
@@ -14,3 +16,10 @@ web_server = Bottle()
 def index():
     print(f"[WEB] GET /", flush=True)
     return f"Progress: {logic.progress}"
+
+
+@web_server.route("/metrics")
+def metrics():
+    print(f"[WEB] GET /metrics", flush=True)
+    response.content_type = "application/json"
+    return json.dumps(logic.metrics.to_dict())
@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import shutil
+from typing import Optional
+
+from app import codec
+
+# bump when the format of the cached summaries changes
+CACHE_VERSION = 3
+SUMMARY_FILENAME = "summary.bin"
+DATA_FILENAME = "data.feather"
+
+
+def file_digest(path, block_size: int = 2 ** 20) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class SummaryCache:
+    # Persistent cache of the local column summaries and, optionally, of a parsed columnar copy of the input, so
+    # that an unchanged input file does not have to be parsed and scanned again.
+    # Entries are keyed by size, mtime and content hash of the input file and the parameters the summary depends on.
+    # Every entry is a directory, the least recently used entries are evicted once max_size bytes are exceeded.
+
+    def __init__(self, directory, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, path, **params) -> str:
+        stat = os.stat(path)
+        key = repr((CACHE_VERSION, stat.st_size, stat.st_mtime_ns, file_digest(path), sorted(params.items())))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def derive_key(self, key: str, **params) -> str:
+        # key of an entry that depends on further parameters than the entry of key
+        return hashlib.sha256(repr((key, sorted(params.items()))).encode()).hexdigest()
+
+    def _path(self, key: str, filename: str) -> str:
+        return os.path.join(self.directory, key, filename)
+
+    def _lookup(self, key: str, filename: str) -> Optional[str]:
+        path = self._path(key, filename)
+        if not os.path.exists(path):
+            return None
+        # the modification time of the entry marks its last use
+        os.utime(os.path.join(self.directory, key))
+        return path
+
+    def _store(self, key: str, filename: str, write):
+        # write to a temporary file first, so that an interrupted run never leaves a partial entry
+        os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+        path = self._path(key, filename)
+        tmp_path = path + ".tmp"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        os.utime(os.path.join(self.directory, key))
+        self.evict(keep=key)
+
+    def get_summary(self, key: str):
+        # summaries are stored in the format of app.codec, which unlike pickle cannot execute code on load
+        path = self._lookup(key, SUMMARY_FILENAME)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            payload = f.read()
+        try:
+            return codec.loads(payload)
+        except ValueError as e:
+            logging.info(f"Ignore invalid cache entry {key}: {e}")
+            return None
+
+    def put_summary(self, key: str, summary):
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(codec.dumps(summary))
+
+        self._store(key, SUMMARY_FILENAME, write)
+
+    def get_data_path(self, key: str) -> Optional[str]:
+        return self._lookup(key, DATA_FILENAME)
+
+    def put_data(self, key: str, table):
+        # stored as feather (arrow IPC), which can be memory-mapped when it is read again. Tables arrow cannot
+        # represent, e.g. columns with mixed types, are not cached
+        try:
+            self._store(key, DATA_FILENAME, lambda path: table.reset_index(drop=True).to_feather(path))
+        except Exception as e:
+            logging.info(f"Input data not cached: {e}")
+
+    def evict(self, keep: Optional[str] = None):
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), key, size))
+
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logging.info(f"Evict cache entry {key}")
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
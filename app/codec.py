@@ -0,0 +1,194 @@
+# Compact binary format for the data exchanged between the nodes.
+#
+# A payload consists of a header (magic bytes, format version, flags) followed by the body, which is zlib compressed
+# if that makes it smaller. The body starts with a table of all distinct strings, every string in the value refers
+# to it by index, so category levels repeated across columns and clients are only sent once. Values are tagged with
+# their type, integer and string levels therefore keep their type on the round trip.
+import numbers
+import struct
+import zlib
+
+MAGIC = b"FCOH"
+VERSION = 1
+FLAG_COMPRESSED = 1
+
+_NONE = b"N"
+_TRUE = b"T"
+_FALSE = b"F"
+_INT = b"i"
+_FLOAT = b"f"
+_STR = b"s"
+_BYTES = b"b"
+_LIST = b"l"
+_TUPLE = b"t"
+_SET = b"S"
+_DICT = b"d"
+
+_DOUBLE = struct.Struct("<d")
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: memoryview, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class _Encoder:
+    def __init__(self):
+        self.strings = {}
+        self.body = bytearray()
+
+    def string_index(self, value: str) -> int:
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def encode(self, value):
+        out = self.body
+        if value is None:
+            out += _NONE
+        elif isinstance(value, bool) or type(value).__name__ == "bool_":  # also numpy.bool_
+            out += _TRUE if value else _FALSE
+        elif isinstance(value, numbers.Integral):
+            # zigzag encoding for signed integers of any size
+            value = int(value)
+            out += _INT
+            _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, numbers.Real):
+            out += _FLOAT
+            out += _DOUBLE.pack(float(value))
+        elif isinstance(value, str):
+            out += _STR
+            _write_varint(out, self.string_index(value))
+        elif isinstance(value, (bytes, bytearray)):
+            out += _BYTES
+            _write_varint(out, len(value))
+            out += value
+        elif isinstance(value, dict):
+            out += _DICT
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                self.encode(key)
+                self.encode(item)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            out += _LIST if isinstance(value, list) else _TUPLE if isinstance(value, tuple) else _SET
+            _write_varint(out, len(value))
+            for item in value:
+                self.encode(item)
+        else:
+            raise TypeError(f"Cannot encode values of type {type(value).__name__}")
+
+    def string_table(self) -> bytearray:
+        out = bytearray()
+        _write_varint(out, len(self.strings))
+        for value in self.strings:
+            encoded = value.encode("utf-8")
+            _write_varint(out, len(encoded))
+            out += encoded
+        return out
+
+
+class _Decoder:
+    def __init__(self, data: memoryview):
+        self.data = data
+        self.pos = 0
+        count, self.pos = _read_varint(data, self.pos)
+        self.strings = []
+        for _ in range(count):
+            length, self.pos = _read_varint(data, self.pos)
+            self.strings.append(str(data[self.pos:self.pos + length], "utf-8"))
+            self.pos += length
+
+    def decode(self):
+        data = self.data
+        tag = bytes(data[self.pos:self.pos + 1])
+        self.pos += 1
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _INT:
+            value, self.pos = _read_varint(data, self.pos)
+            return value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+        if tag == _FLOAT:
+            value = _DOUBLE.unpack_from(data, self.pos)[0]
+            self.pos += _DOUBLE.size
+            return value
+        if tag == _STR:
+            index, self.pos = _read_varint(data, self.pos)
+            return self.strings[index]
+        if tag == _BYTES:
+            length, self.pos = _read_varint(data, self.pos)
+            value = bytes(data[self.pos:self.pos + length])
+            self.pos += length
+            return value
+        if tag == _DICT:
+            length, self.pos = _read_varint(data, self.pos)
+            result = {}
+            for _ in range(length):
+                key = self.decode()
+                result[key] = self.decode()
+            return result
+        if tag in (_LIST, _TUPLE, _SET):
+            length, self.pos = _read_varint(data, self.pos)
+            items = [self.decode() for _ in range(length)]
+            if tag == _LIST:
+                return items
+            return tuple(items) if tag == _TUPLE else set(items)
+        raise ValueError(f"Invalid payload, unknown tag {tag!r} at position {self.pos - 1}")
+
+
+def dumps(value, compress: bool = True, level: int = 6) -> bytes:
+    encoder = _Encoder()
+    encoder.encode(value)
+    body = bytes(encoder.string_table() + encoder.body)
+
+    flags = 0
+    if compress:
+        compressed = zlib.compress(body, level)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+
+    return MAGIC + bytes([VERSION, flags]) + body
+
+
+def loads(payload: bytes):
+    # truncated or corrupt payloads raise a ValueError like any other invalid payload
+    payload = memoryview(payload)
+    if len(payload) < len(MAGIC) + 2 or bytes(payload[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Invalid payload, missing header")
+    version, flags = payload[len(MAGIC)], payload[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError(f"Unsupported payload version {version}, expected {VERSION}")
+
+    body = payload[len(MAGIC) + 2:]
+    try:
+        if flags & FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            body = memoryview(decompressor.decompress(body))
+            if not decompressor.eof or decompressor.unused_data:
+                raise ValueError("Invalid payload, incomplete or trailing compressed data")
+        decoder = _Decoder(body)
+        value = decoder.decode()
+    except (IndexError, TypeError, struct.error, zlib.error) as e:
+        raise ValueError(f"Invalid payload, {type(e).__name__}: {e}") from e
+    if decoder.pos != len(body):
+        raise ValueError(f"Invalid payload, {len(body) - decoder.pos} bytes after position {decoder.pos}")
+    return value
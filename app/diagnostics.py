@@ -0,0 +1,45 @@
+import itertools
+
+# the number of items of a container and characters of a string shown in a preview
+PREVIEW_ITEMS = 10
+PREVIEW_CHARS = 1000
+
+
+class Lazy:
+    # Defers a computation for a log message until the message is formatted, which only happens if its level is
+    # enabled, e.g. logging.debug("summary: %s", Lazy(preview, summary))
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+def preview(value, items: int = PREVIEW_ITEMS, chars: int = PREVIEW_CHARS) -> str:
+    # a short representation of a possibly large object: containers show their first items, tables their shape and
+    # first rows, everything is cut after chars characters
+    if isinstance(value, dict):
+        text = _preview_items([f"{key!r}: {preview(item, items, chars)}"
+                               for key, item in itertools.islice(value.items(), items)], len(value), "{", "}")
+    elif isinstance(value, (set, frozenset, list, tuple)):
+        opening, closing = ("[", "]") if isinstance(value, list) else ("(", ")") if isinstance(value, tuple) \
+            else ("{", "}")
+        text = _preview_items([repr(item) for item in itertools.islice(value, items)], len(value), opening, closing)
+    elif hasattr(value, "shape") and hasattr(value, "head"):
+        # data frames and series
+        text = f"{type(value).__name__} of shape {value.shape}\n{value.head(items)}"
+    else:
+        text = repr(value)
+
+    if len(text) > chars:
+        return f"{text[:chars]}... ({len(text) - chars} more characters)"
+    return text
+
+
+def _preview_items(parts, length: int, opening: str, closing: str) -> str:
+    if length > len(parts):
+        parts.append(f"... ({length - len(parts)} more)")
+    return opening + ", ".join(parts) + closing
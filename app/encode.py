@@ -2,69 +2,369 @@
 # which is licensed under the GPL-3.0 License.
 # This code therefore is also licensed under the terms of the GNU General Public License, version 3.
 
-from typing import Dict, Set, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set, List, Union, Optional, Iterable
 
 import numpy
 import pandas
 from pandas.api.types import is_categorical_dtype
 
+from .plan import EncodingPlan, compile_plan
 
-def _get_mat(data, column_levels: List[Union[str, int]]):
-    cat = pandas.Categorical(data, categories=column_levels)
 
-    dummy_mat = numpy.eye(len(column_levels)).take(cat.codes, axis=0)
+# onehot writes M-1 indicator columns per categorical column, ordinal replaces the column with its category codes
+ENCODINGS = ["onehot", "ordinal"]
+
+# dtypes the indicator blocks can be emitted in
+INDICATOR_DTYPES = {
+    "float64": numpy.float64,
+    "uint8": numpy.uint8,
+    "bool": numpy.bool_,
+}
+
+
+def _is_compact(dtype) -> bool:
+    # compact dtypes cannot hold NaN, rows with unknown categories are tracked in a validity mask instead
+    return numpy.dtype(dtype).kind != "f"
+
+
+def _get_sparse_mat(codes: numpy.ndarray, n_levels: int, nan_rows: numpy.ndarray, dtype=numpy.float64):
+    # build the indicator matrix in CSR form straight from the codes: one nonzero per row with a known category,
+    # rows in nan_rows get an explicit NaN in every column
+    from scipy import sparse
+
+    n_rows = len(codes)
+    known = codes != -1
+    n_nan = int(nan_rows.sum())
+    if n_nan > 0:
+        dtype = numpy.float64
+
+    row_nnz = numpy.where(nan_rows, n_levels, known.astype(numpy.int64))
+    indptr = numpy.zeros(n_rows + 1, dtype=numpy.int64)
+    numpy.cumsum(row_nnz, out=indptr[1:])
+
+    indices = numpy.empty(indptr[-1], dtype=numpy.int32)
+    data = numpy.ones(indptr[-1], dtype=dtype)
+    known_rows = known & ~nan_rows
+    indices[indptr[:-1][known_rows]] = codes[known_rows]
+    if n_nan > 0:
+        nan_pos = (indptr[:-1][nan_rows][:, None] + numpy.arange(n_levels)).ravel()
+        indices[nan_pos] = numpy.tile(numpy.arange(n_levels, dtype=numpy.int32), n_nan)
+        data[nan_pos] = numpy.nan
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_levels))
+
+
+def _get_mat(codes: numpy.ndarray, n_levels: int, nan_rows: numpy.ndarray, sparse: bool = False,
+             dtype=numpy.float64, out: Optional[numpy.ndarray] = None):
+    # indicator matrix without the column of the first level, dense matrices are written into out if given
+    if sparse:
+        return _get_sparse_mat(codes, n_levels, nan_rows, dtype=dtype)[:, 1:]
+
+    if out is None:
+        out = numpy.zeros((len(codes), n_levels - 1), dtype=dtype, order="F")
+
+    rows = numpy.flatnonzero(codes > 0)
+    out[rows, codes[rows] - 1] = 1
 
     # reset NaN GH4446
-    dummy_mat[cat.codes == -1] = numpy.nan
+    if not _is_compact(dtype):
+        out[nan_rows] = numpy.nan
 
-    return dummy_mat
+    return out
 
 
-def _encode_categorical_series(series, levels: Dict[str, Set[Union[str, int]]]):
-    levels_for_series: List[Union[str, int]] = sorted(levels[series.name])
-    enc = _get_mat(series, levels_for_series)
-    if enc is None:
-        return
+def _to_masked_array(values: numpy.ndarray, mask: numpy.ndarray):
+    # nullable counterpart of a compact indicator column, used when the input had missing values
+    if values.dtype == numpy.bool_:
+        return pandas.arrays.BooleanArray(values, mask)
+    return pandas.arrays.IntegerArray(values, mask)
 
-    if enc is None:
-        return pandas.Series(index=series.index, name=series.name, dtype=series.dtype)
 
-    if enc.shape[1] == 1:
-        return series
+def _get_codes(series, plan: EncodingPlan) -> numpy.ndarray:
+    codes = pandas.Categorical(series, dtype=plan.categorical_dtypes[series.name]).codes
+    other_code = plan.other_codes.get(series.name)
+    if other_code is not None:
+        codes = codes.copy()
+        codes[(codes == -1) & series.notna().to_numpy()] = other_code
+    return codes
 
-    names = []
-    for key in range(1, enc.shape[1]):
-        names.append("{}={}".format(series.name, levels_for_series[key]))
-    series = pandas.DataFrame(enc[:, 1:], columns=names, index=series.index)
 
-    return series
+def _encode_categorical_series(series, plan: EncodingPlan, sparse: bool = False, dtype=numpy.float64,
+                               codes: Optional[numpy.ndarray] = None, out: Optional[numpy.ndarray] = None):
+    levels_for_series: List[Union[str, int]] = plan.levels[series.name]
+    if codes is None:
+        codes = _get_codes(series, plan)
+
+    # columns with a single level are passed through unchanged, none of their values introduces a missing value
+    if plan.widths[series.name] == 0:
+        return series, numpy.zeros(len(series), dtype=bool)
+
+    # values that are missing in the input stay missing, values that are not part of the levels are unknown
+    missing = series.isna().to_numpy()
+    unknown = (codes == -1) & ~missing
+
+    compact = _is_compact(dtype)
+    nan_rows = missing if compact else codes == -1
+    enc = _get_mat(codes, len(levels_for_series), nan_rows, sparse=sparse, dtype=dtype, out=out)
+
+    names = plan.names[series.name]
+    if sparse:
+        series = pandas.DataFrame.sparse.from_spmatrix(enc, index=series.index, columns=names)
+    elif compact and missing.any():
+        series = pandas.DataFrame({name: _to_masked_array(enc[:, i], missing) for i, name in enumerate(names)},
+                                  index=series.index)
+    else:
+        series = pandas.DataFrame(enc, columns=names, index=series.index, copy=False)
+
+    return series, unknown
 
 
 def is_categorical_or_object(series):
     return is_categorical_dtype(series.dtype) or series.dtype.char == "O"
 
 
-def encode_categorical(table, levels: Dict[str, Set[Union[str, int]]]):
+def _map_columns(func, items: list, workers: int = 1) -> list:
+    # apply func to every item, with workers > 1 in a thread pool; results keep the order of items
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def encode_categorical(table, levels: Union[EncodingPlan, Dict[str, Set[Union[str, int]]]], sparse: bool = False,
+                       dtype=numpy.float64,
+                       return_valid_rows: bool = False, codes: Optional[Dict[str, numpy.ndarray]] = None,
+                       workers: int = 1):
+    # with sparse=True the indicator columns are pandas SparseDtype columns (fill value 0) built from a CSR matrix.
+    # With a compact dtype (uint8 or bool) rows with unknown categories are all-zero; pass return_valid_rows=True
+    # to additionally get the per-row validity mask (False where a value was not part of the levels).
+    # Codes already computed by get_codes can be passed to skip recomputing them.
+    # With workers > 1 the columns are encoded in parallel, the result is the same as with a single worker.
+    plan = compile_plan(levels)
+    if codes is None:
+        codes = {}
     if isinstance(table, pandas.Series):
         if not is_categorical_dtype(table.dtype) and not table.dtype.char == "O":
             raise TypeError("series must be of categorical dtype, but was {}".format(table.dtype))
-        return _encode_categorical_series(table, levels)
+        encoded, unknown = _encode_categorical_series(table, plan, sparse=sparse, dtype=dtype,
+                                                      codes=codes.get(table.name))
+        if return_valid_rows:
+            return encoded, ~unknown
+        return encoded
+
+    def encode(item):
+        name, series, out = item
+        return _encode_categorical_series(series, plan, sparse=sparse, dtype=dtype, codes=codes.get(name), out=out)
 
-    columns_to_encode = set(levels.keys())
+    items = list(table.items())
+    encode_positions = [i for i, (name, _) in enumerate(items) if name in plan]
 
-    items = []
-    for name, series in table.iteritems():
-        if name in columns_to_encode:
-            series = _encode_categorical_series(series, levels)
-            if series is None:
-                continue
-        items.append(series)
+    if sparse:
+        encoded = _map_columns(encode, [(*items[i], None) for i in encode_positions], workers)
+        valid_rows = numpy.ones(len(table), dtype=bool)
+        items = [series for _, series in items]
+        for i, (series, unknown) in zip(encode_positions, encoded):
+            items[i] = series
+            valid_rows &= ~unknown
 
-    # concat columns of tables
-    new_table = pandas.concat(items, axis=1, copy=False)
+        # concat columns of tables
+        new_table = pandas.concat(items, axis=1, copy=False)
+    else:
+        new_table, valid_rows = _assemble(table, plan, items, encode_positions, encode, dtype, workers)
+
+    if return_valid_rows:
+        return new_table, valid_rows
+    return new_table
+
+
+def _assemble(table, plan: EncodingPlan, items, encode_positions, encode, dtype, workers):
+    # compute the output layout up front and allocate one buffer for the indicator columns of all encoded columns.
+    # Every encoded column writes into its own slice of the buffer, which becomes the block of the indicator columns
+    # in the output frame without a copy
+    compact = _is_compact(dtype)
+    # compact columns with missing values become nullable columns outside of the buffer
+    buffer_positions = [i for i in encode_positions
+                        if plan.widths[items[i][0]] > 0 and not (compact and items[i][1].hasnans)]
+    offsets = plan.offsets(items[i][0] for i in buffer_positions)
+    in_buffer = {}
+    for i in buffer_positions:
+        name = items[i][0]
+        in_buffer[i] = (offsets[name], offsets[name] + plan.widths[name])
+    width = sum(plan.widths[items[i][0]] for i in buffer_positions)
+    buffer = numpy.zeros((len(table), width), dtype=dtype, order="F")
+
+    encode_items = []
+    for i in encode_positions:
+        name, series = items[i]
+        out = buffer[:, slice(*in_buffer[i])] if i in in_buffer else None
+        encode_items.append((name, series, out))
+    encoded = _map_columns(encode, encode_items, workers)
+
+    valid_rows = numpy.ones(len(table), dtype=bool)
+    parts = [series for _, series in items]
+    for i, (part, unknown) in zip(encode_positions, encoded):
+        parts[i] = part
+        valid_rows &= ~unknown
+
+    # output positions of the indicator columns in the buffer and of all other columns, with their arrays
+    names = []
+    buffer_locs = []
+    other_locs = []
+    others = []
+    for i, part in enumerate(parts):
+        if i in in_buffer:
+            buffer_locs.extend(range(len(names), len(names) + part.shape[1]))
+            names.extend(part.columns)
+        elif isinstance(part, pandas.Series):
+            other_locs.append(len(names))
+            others.append(part.array)
+            names.append(part.name)
+        else:
+            other_locs.extend(range(len(names), len(names) + part.shape[1]))
+            others.extend(column.array for _, column in part.items())
+            names.extend(part.columns)
+    new_table = _from_blocks(buffer, buffer_locs, others, other_locs, names, table.index)
+
+    return new_table, valid_rows
+
+
+def _from_blocks(buffer: numpy.ndarray, buffer_locs: List[int], others: list, other_locs: List[int], names: list,
+                 index: pandas.Index) -> pandas.DataFrame:
+    # Builds the output frame from the buffer as one block and the other columns, consolidated into one block per
+    # dtype, at their positions in the output. Passing the blocks to the manager directly keeps pandas from
+    # consolidating the buffer with other float columns, which copies it, and from inserting the other columns one
+    # at a time, which is quadratic in their number
+    from pandas.core.internals import BlockManager
+    from pandas.core.internals.api import make_block
+
+    blocks = []
+    if buffer.shape[1] > 0:
+        # the buffer is in Fortran order, so its transpose is the C-ordered 2-D array of a block
+        blocks.append(make_block(buffer.T, placement=buffer_locs, ndim=2))
+    if others:
+        # keys are positions, so duplicate column names are kept
+        other_locs = numpy.asarray(other_locs)
+        other_table = pandas.DataFrame(dict(enumerate(others)), index=index)
+        for block in other_table._mgr.blocks:
+            blocks.append(make_block(block.values, placement=other_locs[block.mgr_locs.as_array], ndim=2))
+    columns = pandas.Index(names, tupleize_cols=False)
+    return pandas.DataFrame(BlockManager(blocks, [columns, index]))
+
+
+def _get_code_dtype(n_levels: int):
+    # smallest signed integer type that holds all codes
+    for dtype in (numpy.int8, numpy.int16, numpy.int32):
+        if n_levels <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.int64
+
+
+def encode_ordinal(table: pandas.DataFrame, levels: Union[EncodingPlan, Dict[str, Set[Union[str, int]]]],
+                   return_valid_rows: bool = False, codes: Optional[Dict[str, numpy.ndarray]] = None,
+                   workers: int = 1):
+    # replace every categorical column by the codes of its values in the sorted levels, as int8/int16 depending on
+    # the number of levels. Missing values and values that are not part of the levels are missing in the output,
+    # columns with missing values therefore become nullable Int8/Int16 columns
+    plan = compile_plan(levels)
+    if codes is None:
+        codes = get_codes(table, plan, workers=workers)
+
+    new_table = table.copy(deep=False)
+    valid_rows = numpy.ones(len(table), dtype=bool)
+    for name, column_codes in codes.items():
+        missing = column_codes == -1
+        valid_rows &= ~missing | table[name].isna().to_numpy()
+        values = column_codes.astype(_get_code_dtype(len(plan.levels[name])), copy=False)
+        new_table[name] = _to_masked_array(values, missing) if missing.any() else values
+
+    if return_valid_rows:
+        return new_table, valid_rows
+    return new_table
+
+
+def _decode_block(block: pandas.DataFrame, plan: EncodingPlan, name: str) -> pandas.Series:
+    values = block.to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+    # row-wise argmax over the indicator columns, a row without any positive value has the dropped first level
+    positions = numpy.argmax(values, axis=1)
+    top = values[numpy.arange(len(values)), positions]
+    codes = numpy.where(top > 0, positions + 1, 0)
+    # missing values were encoded as NaN in every indicator column
+    codes[numpy.isnan(values.sum(axis=1))] = -1
+    return pandas.Series(pandas.Categorical.from_codes(codes, dtype=plan.categorical_dtypes[name]), index=block.index,
+                         name=name)
+
+
+def decode_categorical(table: pandas.DataFrame, levels: Union[EncodingPlan, Dict[str, Set[Union[str, int]]]],
+                       workers: int = 1) -> pandas.DataFrame:
+    # inverse of encode_categorical: every block of indicator columns is replaced by a categorical column with the
+    # levels of the plan, other columns are kept. Columns without indicator columns in the table are skipped
+    plan = compile_plan(levels)
+    labels = set(table.columns)
+    blocks = {}
+    for name, names in plan.names.items():
+        present = [label in labels for label in names]
+        if names and all(present):
+            blocks[name] = names
+        elif any(present):
+            raise ValueError(f"Indicator columns of {name!r} are missing: "
+                             f"{[label for label, found in zip(names, present) if not found]}")
+
+    decoded = _map_columns(lambda name: _decode_block(table[blocks[name]], plan, name), list(blocks), workers)
+    first_labels = {names[0]: series for names, series in zip(blocks.values(), decoded)}
+    indicator_labels = {label for names in blocks.values() for label in names}
+    columns = {}
+    for label, series in table.items():
+        if label in first_labels:
+            series = first_labels[label]
+            columns[series.name] = series
+        elif label not in indicator_labels:
+            columns[label] = series
+    return pandas.DataFrame(columns, index=table.index, copy=False)
+
+
+def decode_ordinal(table: pandas.DataFrame, levels: Union[EncodingPlan, Dict[str, Set[Union[str, int]]]],
+                   workers: int = 1) -> pandas.DataFrame:
+    # inverse of encode_ordinal: the code columns are replaced by categorical columns with the levels of the plan
+    plan = compile_plan(levels)
+    names = [name for name in table.columns if name in plan]
+
+    def decode(name):
+        codes = table[name].to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+        codes = numpy.where(numpy.isnan(codes), -1, codes).astype(numpy.int64)
+        return pandas.Categorical.from_codes(codes, dtype=plan.categorical_dtypes[name])
+
+    new_table = table.copy(deep=False)
+    for name, values in zip(names, _map_columns(decode, names, workers)):
+        new_table[name] = values
     return new_table
 
 
 def get_columns_to_encode(table: pandas.DataFrame):
-    columns_to_encode = {nam for nam, s in table.iteritems() if is_categorical_or_object(s)}
+    # decided on the dtypes alone, without building a series per column
+    columns_to_encode = {name for name, dtype in table.dtypes.items()
+                         if is_categorical_dtype(dtype) or dtype.char == "O"}
     return columns_to_encode
+
+
+def get_codes(table: pandas.DataFrame, levels: Union[EncodingPlan, Dict[str, Set[Union[str, int]]]],
+              workers: int = 1) -> Dict[str, numpy.ndarray]:
+    # category codes of every column to encode, -1 marks missing values and values not part of the levels
+    plan = compile_plan(levels)
+    columns = [series for name, series in table.items() if name in plan]
+    column_codes = _map_columns(lambda series: _get_codes(series, plan), columns, workers)
+    return {series.name: c for series, c in zip(columns, column_codes)}
+
+
+def get_valid_rows(table: pandas.DataFrame, codes: Dict[str, numpy.ndarray],
+                   ignore: Iterable[str] = ()) -> numpy.ndarray:
+    # a row is invalid if any of its values is not missing but has no code, i.e. is an unknown category. Unknown
+    # values of the ignored columns are kept
+    ignore = set(ignore)
+    valid_rows = numpy.ones(len(table), dtype=bool)
+    for name, column_codes in codes.items():
+        if name in ignore:
+            continue
+        valid_rows &= (column_codes != -1) | table[name].isna().to_numpy()
+    return valid_rows
@@ -0,0 +1,417 @@
+import gzip
+import io
+import json
+import logging
+import os
+import struct
+from typing import Optional, List, Dict, Any, Iterator, Iterable
+
+import numpy
+import pandas
+
+OUTPUT_FORMATS = ["csv", "parquet", "feather", "npy"]
+
+# input formats by file extension, files with other extensions are read as csv
+INPUT_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+    ".ipc": "feather",
+}
+CSV_ENGINES = ["c", "pyarrow", "python"]
+# pandas formats every cell with the generic formatter, fast writes indicator columns as 0/1 from a lookup table
+CSV_WRITERS = ["pandas", "fast"]
+
+# size of the blocks the fast csv writer formats and writes at once
+CSV_BLOCK_SIZE = 8 * 2 ** 20
+_DIGITS = numpy.frombuffer(b"01", dtype=numpy.uint8)
+
+# fixed size of the .npy header, large enough for any shape so it can be rewritten once the row count is known
+NPY_HEADER_SIZE = 128
+# number of values converted at once when the rows written to a .npy file are promoted to a wider dtype
+NPY_PROMOTE_BLOCK = 2 ** 22
+
+
+def _require_pyarrow(output_format: str):
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(f"The {output_format!r} format requires the pyarrow package") from e
+    return pyarrow
+
+
+def _densify(table: pandas.DataFrame) -> pandas.DataFrame:
+    # columnar writers do not support pandas' sparse columns
+    sparse_columns = [name for name, dtype in table.dtypes.items() if isinstance(dtype, pandas.SparseDtype)]
+    if not sparse_columns:
+        return table
+    table = table.copy(deep=False)
+    for name in sparse_columns:
+        table[name] = table[name].sparse.to_dense()
+    return table
+
+
+def _iter_dense_blocks(table: pandas.DataFrame, block_size: int = CSV_BLOCK_SIZE):
+    # the table in blocks of rows of about block_size bytes with dense columns, a table without sparse columns in one
+    if len(table) == 0 or not any(isinstance(dtype, pandas.SparseDtype) for dtype in table.dtypes):
+        yield _densify(table)
+        return
+    block_rows = max(1, block_size // (8 * max(1, len(table.columns))))
+    for start in range(0, len(table), block_rows):
+        yield _densify(table.iloc[start:start + block_rows])
+
+
+def get_input_format(path, input_format: Optional[str] = None) -> str:
+    if input_format is not None:
+        if input_format not in ["csv", *INPUT_FORMATS.values()]:
+            raise ValueError(f"Unknown input format {input_format!r}")
+        return input_format
+    return INPUT_FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+
+
+def _arrow_to_pandas(arrow_table, categorical_columns: Optional[List[str]] = None):
+    categories = [name for name in categorical_columns or [] if name in arrow_table.column_names]
+    return arrow_table.to_pandas(categories=categories)
+
+
+def _read_arrow(path, input_format: str):
+    # parquet and feather (arrow IPC) files are memory-mapped instead of read into a buffer
+    pyarrow = _require_pyarrow(input_format)
+    if input_format == "parquet":
+        from pyarrow import parquet
+        return parquet.ParquetFile(path, memory_map=True)
+    from pyarrow import ipc
+    return ipc.open_file(pyarrow.memory_map(path, "r"))
+
+
+def read_table(path, input_format: str = "csv", sep: str = ",", columns: Optional[List[str]] = None,
+               categorical_columns: Optional[List[str]] = None, dtype: Optional[Dict[str, Any]] = None,
+               csv_engine: str = "c") -> pandas.DataFrame:
+    # read only the given columns, categorical_columns are loaded as category dtype
+    if input_format == "csv":
+        return pandas.read_csv(path, sep=sep, usecols=columns, engine=csv_engine,
+                               dtype=_get_csv_dtype(dtype, categorical_columns))
+
+    reader = _read_arrow(path, input_format)
+    if input_format == "parquet":
+        arrow_table = reader.read(columns=columns)
+    else:
+        arrow_table = reader.read_all()
+        if columns is not None:
+            arrow_table = arrow_table.select(columns)
+    return _astype(_arrow_to_pandas(arrow_table, categorical_columns), dtype)
+
+
+def iter_table(path, chunksize: int, input_format: str = "csv", sep: str = ",", columns: Optional[List[str]] = None,
+               categorical_columns: Optional[List[str]] = None, dtype: Optional[Dict[str, Any]] = None,
+               csv_engine: str = "c") -> Iterator[pandas.DataFrame]:
+    # read the table in chunks of chunksize rows
+    if input_format == "csv":
+        if csv_engine == "pyarrow":
+            # the pyarrow engine cannot read in chunks
+            csv_engine = "c"
+        with pandas.read_csv(path, sep=sep, usecols=columns, engine=csv_engine, chunksize=chunksize,
+                             dtype=_get_csv_dtype(dtype, categorical_columns)) as reader:
+            yield from reader
+        return
+
+    reader = _read_arrow(path, input_format)
+    if input_format == "parquet":
+        batches = reader.iter_batches(batch_size=chunksize, columns=columns)
+    else:
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    import pyarrow
+    for batch in batches:
+        if columns is not None and input_format != "parquet":
+            batch = batch.select(columns)
+        for start in range(0, batch.num_rows, chunksize):
+            arrow_table = pyarrow.Table.from_batches([batch.slice(start, chunksize)])
+            yield _astype(_arrow_to_pandas(arrow_table, categorical_columns), dtype)
+
+
+def _get_csv_dtype(dtype: Optional[Dict[str, Any]], categorical_columns: Optional[List[str]]):
+    dtype = dict(dtype or {})
+    dtype.update({name: "category" for name in categorical_columns or []})
+    return dtype or None
+
+
+def common_dtype(dtypes: Iterable[Any]):
+    # a dtype that holds the values of all given dtypes, e.g. of a column over all chunks: the widest numeric dtype
+    # if all of them are numeric, otherwise object
+    dtypes = set(dtypes)
+    if len(dtypes) == 1:
+        return dtypes.pop()
+    if all(isinstance(dtype, numpy.dtype) and dtype.kind in "iuf" for dtype in dtypes):
+        return numpy.result_type(*dtypes)
+    return numpy.dtype(object)
+
+
+def _astype(table: pandas.DataFrame, dtype: Optional[Dict[str, Any]]):
+    dtype = {name: column_dtype for name, column_dtype in (dtype or {}).items() if name in table.columns}
+    return table.astype(dtype) if dtype else table
+
+
+def get_manifest_path(path) -> str:
+    return os.path.splitext(path)[0] + ".columns.json"
+
+
+def _is_indicator_block(values: numpy.ndarray) -> bool:
+    return bool(numpy.isin(values[~numpy.isnan(values)], (0, 1)).all())
+
+
+def _format_indicator_block(values: numpy.ndarray, sep: bytes, last: bool) -> List[bytes]:
+    # the cells of every row as b"0,1,0," from a lookup table, without the trailing separator if the block ends the
+    # row. Missing values are written as empty cells, as pandas does
+    n_rows, n_columns = values.shape
+    out = numpy.empty((n_rows, 2 * n_columns), dtype=numpy.uint8)
+    out[:, 1::2] = sep[0]
+    missing = numpy.isnan(values)
+    out[:, 0::2] = _DIGITS[numpy.where(missing, 0, values).astype(numpy.uint8)]
+
+    width = 2 * n_columns
+    row_width = width - 1 if last else width
+    buffer = out.tobytes()
+    rows = [buffer[start:start + row_width] for start in range(0, len(buffer), width)]
+    for i in numpy.flatnonzero(missing.any(axis=1)):
+        cells = [b"" if is_missing else b"%d" % value for value, is_missing in zip(values[i], missing[i])]
+        rows[i] = sep.join(cells) + (b"" if last else sep)
+    return rows
+
+
+def _format_other_block(table: pandas.DataFrame, sep: bytes, last: bool) -> Optional[List[bytes]]:
+    # pandas formats the remaining columns, None if a row cannot be told apart by line breaks (quoted newlines)
+    text = table.to_csv(sep=sep.decode(), index=False, header=False, lineterminator="\n").encode()
+    rows = text.split(b"\n")[:-1]
+    if len(rows) != len(table):
+        return None
+    if not last:
+        rows = [row + sep for row in rows]
+    return rows
+
+
+def _column_runs(table: pandas.DataFrame, indicator_columns: Iterable[str]):
+    # consecutive columns that are either all indicators or all other columns, as (is_indicator, positions)
+    indicator_columns = set(indicator_columns)
+    runs = []
+    for i, (name, dtype) in enumerate(table.dtypes.items()):
+        is_indicator = name in indicator_columns and not pandas.api.types.is_bool_dtype(dtype) and \
+                       pandas.api.types.is_numeric_dtype(dtype)
+        if runs and runs[-1][0] == is_indicator:
+            runs[-1][1].append(i)
+        else:
+            runs.append((is_indicator, [i]))
+    return runs
+
+
+def write_csv_fast(f, table: pandas.DataFrame, indicator_columns: Iterable[str], sep: str = ",", header: bool = True):
+    # Writes table to the binary file f like DataFrame.to_csv, except that the 0/1 indicator columns are written as
+    # integers. Rows are formatted and written in blocks of about CSV_BLOCK_SIZE bytes
+    if header:
+        f.write(table.iloc[:0].to_csv(sep=sep, index=False, lineterminator="\n").encode())
+    table = _densify(table)
+    if len(sep) != 1 or len(table) == 0 or len(table.columns) == 0:
+        f.write(table.to_csv(sep=sep, index=False, header=False, lineterminator="\n").encode())
+        return
+
+    sep = sep.encode()
+    runs = _column_runs(table, indicator_columns)
+    row_width = sum(2 * len(positions) if is_indicator else 16 * len(positions) for is_indicator, positions in runs)
+    block_rows = max(1, CSV_BLOCK_SIZE // row_width)
+
+    for start in range(0, len(table), block_rows):
+        block = table.iloc[start:start + block_rows]
+        parts = []
+        for j, (is_indicator, positions) in enumerate(runs):
+            last = j == len(runs) - 1
+            rows = None
+            if is_indicator:
+                values = block.iloc[:, positions].to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+                if _is_indicator_block(values):
+                    rows = _format_indicator_block(values, sep, last)
+            if rows is None:
+                rows = _format_other_block(block.iloc[:, positions], sep, last)
+            if rows is None:
+                # fall back to pandas for the whole block
+                parts = None
+                break
+            parts.append(rows)
+
+        if parts is None:
+            f.write(block.to_csv(sep=sep.decode(), index=False, header=False, lineterminator="\n").encode())
+        else:
+            f.write(b"\n".join(map(b"".join, zip(*parts))) + b"\n")
+
+
+class TableWriter:
+    # Writes a table in one or several chunks of rows to csv, parquet, feather or a memory-mappable .npy file.
+    # Parquet and feather keep the column types (uint8/bool indicators are stored bit-packed or dictionary
+    # encoded), the .npy format stores a single numeric matrix and writes the column names to a JSON manifest.
+    # Csv files with a .gz extension are gzip compressed while writing; with csv_writer="fast" the indicator_columns
+    # are written as 0/1 integers by write_csv_fast.
+    # The column types are fixed by dtypes where given, e.g. for the indicator columns, and by the first chunk
+    # otherwise. Later chunks are checked against them: parquet and feather fail instead of truncating values that
+    # do not fit, the rows of a .npy file already written are promoted to a wider dtype.
+
+    def __init__(self, path, output_format: str = "csv", sep: str = ",", csv_writer: str = "pandas",
+                 indicator_columns: Iterable[str] = (), dtypes: Optional[Dict[str, Any]] = None):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}, must be one of {OUTPUT_FORMATS}")
+        if csv_writer not in CSV_WRITERS:
+            raise ValueError(f"Unknown csv writer {csv_writer!r}, must be one of {CSV_WRITERS}")
+        self.path = path
+        self.output_format = output_format
+        self.sep = sep
+        self.csv_writer = csv_writer
+        self.indicator_columns = set(indicator_columns)
+        self.dtypes = dict(dtypes or {})
+        self.columns = None
+        self.n_rows = 0
+        self._writer = None
+        self._file = None
+        self._dtype = None
+        self._schema = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, table: pandas.DataFrame):
+        if self.columns is None:
+            self.columns = list(table.columns)
+        getattr(self, f"_write_{self.output_format}")(table)
+        self.n_rows += len(table)
+
+    def _write_csv(self, table: pandas.DataFrame):
+        first = self._file is None
+        if first:
+            if str(self.path).endswith(".gz"):
+                self._file = gzip.open(self.path, "wb", compresslevel=6)
+            else:
+                self._file = open(self.path, "wb", buffering=CSV_BLOCK_SIZE)
+        if self.csv_writer == "fast":
+            write_csv_fast(self._file, table, self.indicator_columns, sep=self.sep, header=first)
+        else:
+            if self._writer is None:
+                self._writer = io.TextIOWrapper(self._file, encoding="utf-8", newline="")
+            # sparse columns are densified in blocks of rows, pandas writes their fill value like an integer
+            for block in _iter_dense_blocks(table):
+                block.to_csv(self._writer, sep=self.sep, index=False, header=first, lineterminator=os.linesep)
+                first = False
+
+    def _to_arrow(self, table: pandas.DataFrame):
+        pyarrow = _require_pyarrow(self.output_format)
+        arrow_table = pyarrow.Table.from_pandas(_densify(table), preserve_index=False)
+        if self._schema is None:
+            fields = [pyarrow.field(field.name, pyarrow.from_numpy_dtype(self.dtypes[field.name]))
+                      if field.name in self.dtypes else field for field in arrow_table.schema]
+            self._schema = pyarrow.schema(fields, metadata=arrow_table.schema.metadata)
+        if not arrow_table.schema.equals(self._schema, check_metadata=False):
+            try:
+                arrow_table = arrow_table.cast(self._schema, safe=True)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError) as e:
+                changed = {field.name: f"{self._schema.field(field.name).type} -> {field.type}"
+                           for field in arrow_table.schema if field.type != self._schema.field(field.name).type}
+                raise ValueError(f"The column types changed after row {self.n_rows} of {self.path}: {changed}") from e
+        return arrow_table
+
+    def _write_parquet(self, table: pandas.DataFrame):
+        arrow_table = self._to_arrow(table)
+        if self._writer is None:
+            from pyarrow import parquet
+            self._writer = parquet.ParquetWriter(self.path, arrow_table.schema, use_dictionary=True)
+        self._writer.write_table(arrow_table)
+
+    def _write_feather(self, table: pandas.DataFrame):
+        arrow_table = self._to_arrow(table)
+        if self._writer is None:
+            from pyarrow import ipc
+            self._writer = ipc.new_file(self.path, arrow_table.schema)
+        self._writer.write_table(arrow_table)
+
+    def _write_npy(self, table: pandas.DataFrame):
+        table = _densify(table)
+        non_numeric = [name for name, dtype in table.dtypes.items()
+                       if not (pandas.api.types.is_numeric_dtype(dtype) or pandas.api.types.is_bool_dtype(dtype))]
+        if non_numeric:
+            raise ValueError(f"The npy format only supports numeric columns, use parquet or feather for "
+                             f"{non_numeric}")
+
+        # nullable columns are stored as float with NaN for missing values
+        dtypes = [numpy.float64 if isinstance(dtype, pandas.api.extensions.ExtensionDtype) else dtype
+                  for dtype in table.dtypes]
+        dtype = numpy.result_type(*dtypes) if dtypes else numpy.dtype(numpy.float64)
+        if self._file is None:
+            self._dtype = numpy.result_type(dtype, *self.dtypes.values())
+            self._file = open(self.path, "w+b")
+            self._write_npy_header()
+        elif not numpy.can_cast(dtype, self._dtype, casting="safe"):
+            self._promote_npy(numpy.result_type(self._dtype, dtype))
+
+        if self._dtype.kind == "f":
+            values = table.to_numpy(dtype=self._dtype, na_value=numpy.nan)
+        else:
+            values = table.to_numpy(dtype=self._dtype)
+        self._file.write(numpy.ascontiguousarray(values).tobytes())
+
+    def _promote_npy(self, dtype: numpy.dtype):
+        # convert the rows written so far block by block to the wider dtype, the header is rewritten on close
+        logging.info(f"Promote {self.path} from {self._dtype} to {dtype} after row {self.n_rows}")
+        n_values = self.n_rows * len(self.columns)
+        tmp_path = f"{self.path}.tmp"
+        self._file.flush()
+        with open(tmp_path, "wb") as f:
+            f.write(b"\0" * NPY_HEADER_SIZE)
+            if n_values > 0:
+                written = numpy.memmap(self._file, dtype=self._dtype, mode="r", offset=NPY_HEADER_SIZE,
+                                       shape=(n_values,))
+                for start in range(0, n_values, NPY_PROMOTE_BLOCK):
+                    f.write(written[start:start + NPY_PROMOTE_BLOCK].astype(dtype).tobytes())
+                del written
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "r+b")
+        self._file.seek(0, os.SEEK_END)
+        self._dtype = numpy.dtype(dtype)
+
+    def _write_npy_header(self):
+        header = repr({
+            "descr": numpy.lib.format.dtype_to_descr(self._dtype),
+            "fortran_order": False,
+            "shape": (self.n_rows, len(self.columns)),
+        })
+        # magic string, version 1.0, header length; the header is padded with spaces and ends with a newline
+        prefix = b"\x93NUMPY\x01\x00"
+        header_length = NPY_HEADER_SIZE - len(prefix) - 2
+        self._file.write(prefix + struct.pack("<H", header_length) + header.ljust(header_length - 1).encode() + b"\n")
+
+    def close(self):
+        if self.output_format == "npy":
+            if self._file is not None:
+                # now that the number of rows is known, rewrite the header
+                self._file.seek(0)
+                self._write_npy_header()
+                self._file.close()
+                with open(get_manifest_path(self.path), "w") as f:
+                    json.dump({"columns": [str(name) for name in self.columns], "dtype": str(self._dtype),
+                               "shape": [self.n_rows, len(self.columns)]}, f)
+        elif self.output_format == "csv":
+            if self._writer is not None:
+                # closes the underlying file as well
+                self._writer.close()
+            elif self._file is not None:
+                self._file.close()
+        elif self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._file = None
+        logging.debug(f"Wrote {self.n_rows} rows to {self.path}")
+
+
+def write_table(table: pandas.DataFrame, path, output_format: str = "csv", sep: str = ",", csv_writer: str = "pandas",
+                indicator_columns: Iterable[str] = (), dtypes: Optional[Dict[str, Any]] = None):
+    with TableWriter(path, output_format, sep, csv_writer, indicator_columns, dtypes) as writer:
+        writer.write(table)
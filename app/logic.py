@@ -1,20 +1,38 @@
+import glob
 import logging
 import os
 import shutil
+import tempfile
 import threading
 import time
-from typing import Optional, Dict, List
-
-import jsonpickle
-import pandas
-import yaml
-
-from app.algo import combine, get_categories, encode_categorical, drop_rows_with_introduced_na_values
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Set, Union, IO, Any, TYPE_CHECKING
+
+from app import codec
+from app.diagnostics import Lazy, preview
+from app.metrics import Metrics, RUN_SUMMARY_FILENAME
+
+# The data stack (numpy, pandas, pyarrow, yaml) is imported where it is used, so the API can answer the controller
+# right after startup. The app flow loads it first thing on its worker thread.
+if TYPE_CHECKING:
+    import pandas
+    from app.algo import CategoryDiscovery
+    from app.cache import SummaryCache
+    from app.merger import BackgroundMerger
+    from app.plan import EncodingPlan
+
+# with max_levels set, the nodes send the counts of this many times max_levels categories per column
+LOCAL_LEVELS_FACTOR = 10
+# modes that take the levels from the plan stored by a previous run instead of aggregating them. In decode mode the
+# input files hold encoded data, which is turned back into the categorical columns
+PLAN_MODES = ["plan", "decode"]
+# incoming payloads larger than this are spooled to a temporary file instead of being held in memory
+SPOOL_MAX_SIZE = 2 ** 20
 
 
 class AppLogic:
 
-    def __init__(self):
+    def __init__(self, input_dir: str = "/mnt/input", output_dir: str = "/mnt/output"):
         # === Status of this app instance ===
 
         # Indicates whether there is data to share, if True make sure self.data_out is available
@@ -24,7 +42,9 @@ class AppLogic:
         self.status_finished = False
 
         # === Data ===
-        self.data_incoming = []
+        # payloads received from the controller are spooled files, the own payloads of the coordinator are bytes.
+        # Access both only while holding self.condition
+        self.data_incoming: List[Union[bytes, IO[bytes]]] = []
         self.data_outgoing = None
 
         # === Parameters set during setup ===
@@ -33,23 +53,53 @@ class AppLogic:
         self.clients = None
 
         # === Directories, input files always in INPUT_DIR. Write your output always in OUTPUT_DIR
-        self.INPUT_DIR = "/mnt/input"
-        self.OUTPUT_DIR = "/mnt/output"
+        self.INPUT_DIR = input_dir
+        self.OUTPUT_DIR = output_dir
 
         # === Variables from config.yml
-        self.input_filename = None
+        self.input_filenames: List[str] = []
         self.sep = None
         self.output_filename = None
+        self.output_format = "csv"
+        self.input_format = None
+        self.csv_engine = "c"
+        self.csv_writer = "pandas"
         self.mode = None
+        self.sparse = False
+        self.compression = True
+        self.dtype = "float64"
+        self.encoding = "onehot"
+        self.chunksize: Optional[int] = None
+        self.workers = 1
+        self.max_levels: Optional[int] = None
+        self.max_cardinality: Optional[int] = None
         self.study_definition: Optional[Dict[str, List[str]]] = None
+        self.plan_filename = None
+        self.cache: Optional["SummaryCache"] = None
+        self.cache_data = False
 
         # === Internals ===
         self.thread = None
         self.iteration = 0
         self.progress = "not started yet"
-        self.data = None
-        self.encoded_data = None
+        self.metrics = Metrics()
+        # round of communication the exchanged data is accounted to in the metrics
+        self.round = "mode"
+        self.outgoing_round = None
+        # signalled by handle_incoming and handle_outgoing, the app flow waits on it instead of polling
+        self.condition = threading.Condition()
+        self.events = 0
+        # parsed input files by file name, until they are encoded
+        self.data: Dict[str, "pandas.DataFrame"] = {}
         self.aggregated_col_info = None
+        self.plan: Optional["EncodingPlan"] = None
+        self.mixed_columns: Dict[str, Set[str]] = {}
+        # streaming mode: dtypes of the columns that are passed through, over all chunks of every input file
+        self.column_dtypes: Dict[str, Dict[str, Any]] = {}
+        self.cache_keys: Dict[str, str] = {}
+        self.cached_summaries = {}
+        # coordinator only: merges the column summaries of the clients while they arrive
+        self.merger: Optional["BackgroundMerger"] = None
 
     def handle_setup(self, client_id, master, clients):
         # This method is called once upon startup and contains information about the execution context of this instance
@@ -64,18 +114,104 @@ class AppLogic:
     def handle_incoming(self, data):
         # This method is called when new data arrives
         print("Process incoming data....", flush=True)
-        self.data_incoming.append(data.read())
+        payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        shutil.copyfileobj(data, payload)
+        self.metrics.add_traffic(self.round, received=payload.tell())
+        payload.seek(0)
+        with self.condition:
+            if self.merger is not None:
+                self.merger.submit(payload)
+            else:
+                self.data_incoming.append(payload)
+            self.notify()
 
     def handle_outgoing(self):
         print("Process outgoing data...", flush=True)
         # This method is called when data is requested
-        self.status_available = False
-        return self.data_outgoing
+        with self.condition:
+            self.status_available = False
+            self.notify()
+            # nothing is queued if the data is requested before anything was sent
+            if self.data_outgoing is not None:
+                self.metrics.add_traffic(self.outgoing_round, sent=len(self.data_outgoing))
+            return self.data_outgoing
+
+    def send(self, data: bytes):
+        # make data available to the controller, which picks it up with handle_outgoing
+        with self.condition:
+            self.data_outgoing = data
+            self.outgoing_round = self.round
+            self.status_available = True
+            self.notify()
+
+    def add_incoming(self, data: bytes):
+        with self.condition:
+            self.data_incoming.append(data)
+            self.notify()
+
+    def count_incoming(self) -> int:
+        with self.condition:
+            return len(self.data_incoming)
+
+    def finish(self):
+        with self.condition:
+            self.status_finished = True
+            self.notify()
+
+    def wait_for_status(self, available: bool, finished: bool, timeout: float):
+        # block until status_available or status_finished differs from the given values, at most timeout seconds.
+        # Used by the long-polling status route
+        with self.condition:
+            self.condition.wait_for(lambda: (self.status_available, self.status_finished) != (available, finished),
+                                    timeout)
+            return self.status_available, self.status_finished
+
+    def notify(self):
+        # wake up the app flow, must be called while holding self.condition
+        self.events += 1
+        self.condition.notify_all()
+
+    def wait_for_event(self, events: int):
+        # block until handle_incoming or handle_outgoing was called since the app flow saw `events` events
+        with self.condition:
+            self.condition.wait_for(lambda: self.events != events)
+
+    def wait_until_sent(self):
+        # block until the outgoing data has been picked up
+        with self.condition:
+            self.condition.wait_for(lambda: not self.status_available)
+
+    def take_incoming(self) -> list:
+        with self.condition:
+            data, self.data_incoming = self.data_incoming, []
+        return data
+
+    def encode_payload(self, data) -> bytes:
+        start = time.perf_counter()
+        payload = codec.dumps(data, compress=self.compression)
+        logging.info(f"Encoded payload of {len(payload)} bytes in {time.perf_counter() - start:.4f}s")
+        return payload
+
+    def decode_payload(self, payload: Union[bytes, IO[bytes]]):
+        if not isinstance(payload, bytes):
+            with payload:
+                payload = payload.read()
+        start = time.perf_counter()
+        data = codec.loads(payload)
+        logging.info(f"Decoded payload of {len(payload)} bytes in {time.perf_counter() - start:.4f}s")
+        return data
+
+    def set_progress(self, progress: str):
+        # switch to the next step of the app flow and account the time spent in the previous one
+        if progress == self.progress:
+            return
+        self.progress = progress
+        self.metrics.enter_state(progress)
 
     def parse_study_definition(self, config):
         directive = "categorical_variables"
         definition = config.get(directive)
-        logging.debug(f"definition:\t{definition}")
+        logging.debug("definition:\t%s", Lazy(preview, definition))
         if definition is None:
             raise ValueError(f"When mode is set to {self.mode!r} the config file of the coordinator "
                              f"must define a {directive!r} directive.")
@@ -97,21 +233,75 @@ class AppLogic:
                 raise ValueError(definition_structure_help_text)
 
         self.study_definition = definition
-        logging.debug(f"study_definition:\t{self.study_definition}")
+        logging.debug("study_definition:\t%s", Lazy(preview, self.study_definition))
 
     def read_config(self):
+        import yaml
+        from app.encode import ENCODINGS, INDICATOR_DTYPES
+        from app.formats import OUTPUT_FORMATS, CSV_ENGINES, CSV_WRITERS, get_input_format
+        from app.plan import EncodingPlan
+
         logging.debug(f"Read config file.")
         with open(os.path.join(self.INPUT_DIR, "config.yml")) as f:
             config = yaml.load(f, Loader=yaml.FullLoader)["fc_one_hot_encoding"]
-            self.input_filename = config["files"]["input_filename"]
+            # debug messages, e.g. previews of the summaries and the data, are only formatted with log_level debug
+            log_level = str(config.get("log_level", "info")).upper()
+            if not isinstance(logging.getLevelName(log_level), int):
+                raise ValueError(f"Unknown log level {log_level!r}")
+            logging.getLogger().setLevel(log_level)
+            self.input_filenames = self.resolve_input_filenames(config["files"]["input_filename"])
             self.output_filename = config["files"]["output_filename"]
+            output_filenames = {self.get_output_filename(filename) for filename in self.input_filenames}
+            if len(output_filenames) < len(self.input_filenames):
+                raise ValueError("With several input files the output_filename must contain {name} or {stem}")
             self.sep = config["files"]["sep"]
+            self.chunksize = config["files"].get("chunksize")
+            self.input_format = config["files"].get("input_format")
+            for filename in self.input_filenames:
+                get_input_format(filename, self.input_format)
+            self.csv_engine = config["files"].get("csv_engine", "c")
+            if self.csv_engine not in CSV_ENGINES:
+                raise ValueError(f"Unknown csv engine {self.csv_engine!r}, must be one of {CSV_ENGINES}")
+            self.csv_writer = config["files"].get("csv_writer", "pandas")
+            if self.csv_writer not in CSV_WRITERS:
+                raise ValueError(f"Unknown csv writer {self.csv_writer!r}, must be one of {CSV_WRITERS}")
+            self.output_format = config["files"].get("output_format", "csv")
+            if self.output_format not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown output format {self.output_format!r}, must be one of {OUTPUT_FORMATS}")
+            self.sparse = config.get("sparse", False)
+            self.dtype = config.get("dtype", "float64")
+            self.workers = config.get("workers", 1)
+            self.compression = config.get("compression", True)
+            if self.dtype not in INDICATOR_DTYPES:
+                raise ValueError(f"Unknown dtype {self.dtype!r}, must be one of {list(INDICATOR_DTYPES)}")
+            self.encoding = config.get("encoding", "onehot")
+            if self.encoding not in ENCODINGS:
+                raise ValueError(f"Unknown encoding {self.encoding!r}, must be one of {ENCODINGS}")
+            self.max_levels = config.get("max_levels")
+            self.max_cardinality = config.get("max_cardinality")
+            for key in ["max_levels", "max_cardinality"]:
+                value = config.get(key)
+                if value is not None and (type(value) is not int or value < 1):
+                    raise ValueError(f"{key!r} must be a positive integer")
+
+            cache_dir = config.get("cache_dir")
+            if cache_dir is not None:
+                from app.cache import SummaryCache
+                self.cache = SummaryCache(os.path.join(self.INPUT_DIR, cache_dir),
+                                          config.get("cache_max_size", 1024) * 2 ** 20)
+                self.cache_data = config.get("cache_data", False)
 
             self.mode = config["mode"]
-            if self.mode not in ["auto", "predefined"]:
+            if self.mode not in ["auto", "predefined", *PLAN_MODES]:
                 raise ValueError("Unknown mode")
             logging.debug(f"Mode: {self.mode}")
 
+            if self.mode in PLAN_MODES:
+                # encode with the plan stored by a previous run, this skips the aggregation round
+                self.plan_filename = config["files"]["plan_filename"]
+                self.plan = EncodingPlan.load(os.path.join(self.INPUT_DIR, self.plan_filename))
+                self.aggregated_col_info = self.plan.levels
+
             if self.mode == "predefined":
                 if self.coordinator:
                     self.parse_study_definition(config)
@@ -119,29 +309,402 @@ class AppLogic:
         logging.debug("Copy config file")
         shutil.copyfile(os.path.join(self.INPUT_DIR, "config.yml"), os.path.join(self.OUTPUT_DIR, "config.yml"))
 
-    def read_data(self):
-        path = os.path.join(self.INPUT_DIR, self.input_filename)
-        logging.info(f"Read data file at {path}")
-        dataframe = pandas.read_csv(path, sep=self.sep)
-        logging.debug(f"\n{dataframe}")
+    def resolve_input_filenames(self, input_filename) -> List[str]:
+        # a file name, a list of file names or a glob pattern relative to INPUT_DIR
+        if isinstance(input_filename, list):
+            return input_filename
+        if not any(character in input_filename for character in "*?["):
+            return [input_filename]
+        filenames = sorted(os.path.relpath(path, self.INPUT_DIR)
+                           for path in glob.glob(os.path.join(self.INPUT_DIR, input_filename)))
+        if not filenames:
+            raise ValueError(f"No input files match {input_filename!r}")
+        return filenames
+
+    def get_categorical_columns(self) -> List[str]:
+        # once the levels are known, columns with string levels are loaded directly as category dtype
+        if self.mode == "decode":
+            # the input holds the encoded columns
+            return []
+        if self.plan is not None:
+            levels = self.plan.levels
+        elif self.study_definition is not None:
+            levels = self.study_definition
+        else:
+            return []
+        return [name for name, values in levels.items() if values and all(type(value) is str for value in values)]
+
+    def get_input_format(self, filename: str) -> str:
+        from app.formats import get_input_format
+
+        return get_input_format(filename, self.input_format)
+
+    def read_data(self, filename: str):
+        from app.formats import read_table
+
+        path = os.path.join(self.INPUT_DIR, filename)
+        cached_path = self.cache.get_data_path(self.get_data_cache_key(filename)) if self.cache_data else None
+        if cached_path is not None:
+            logging.info(f"Read cached copy of {path} at {cached_path}")
+            with self.metrics.stage("parse"):
+                dataframe = read_table(cached_path, "feather", categorical_columns=self.get_categorical_columns())
+        else:
+            input_format = self.get_input_format(filename)
+            logging.info(f"Read {input_format} data file at {path}")
+            with self.metrics.stage("parse"):
+                dataframe = read_table(path, input_format, sep=self.sep, csv_engine=self.csv_engine,
+                                       categorical_columns=self.get_categorical_columns())
+            if self.cache_data:
+                self.cache.put_data(self.get_data_cache_key(filename), dataframe)
+        logging.debug("%s", Lazy(preview, dataframe))
         return dataframe
 
+    def get_cache_key(self, filename: str) -> str:
+        # the input file and everything the local summary depends on
+        if filename not in self.cache_keys:
+            self.cache_keys[filename] = self.cache.get_key(
+                os.path.join(self.INPUT_DIR, filename), input_format=self.get_input_format(filename), sep=self.sep,
+                csv_engine=self.csv_engine, chunksize=self.chunksize, max_levels=self.max_levels,
+                max_cardinality=self.max_cardinality)
+        return self.cache_keys[filename]
+
+    def get_data_cache_key(self, filename: str) -> str:
+        # the parsed copy also depends on the columns that are read as category, which differ between the modes
+        return self.cache.derive_key(self.get_cache_key(filename),
+                                     categorical_columns=sorted(self.get_categorical_columns()))
+
+    def get_cached_summary(self, filename: str):
+        if self.cache is None:
+            return None
+        if self.cached_summaries.get(filename) is None:
+            self.cached_summaries[filename] = self.cache.get_summary(self.get_cache_key(filename))
+            if self.cached_summaries[filename] is not None:
+                logging.info(f"Use cached summary of {filename}")
+        return self.cached_summaries[filename]
+
+    def iter_data(self, filename: str, columns: Optional[List[str]] = None, dtype=None):
+        # streaming mode: read the input file in chunks of self.chunksize rows
+        from app.formats import iter_table
+
+        path = os.path.join(self.INPUT_DIR, filename)
+        input_format = self.get_input_format(filename)
+        logging.info(f"Read {input_format} data file at {path} in chunks of {self.chunksize} rows")
+        chunks = iter_table(path, self.chunksize, input_format, sep=self.sep, columns=columns, dtype=dtype,
+                            categorical_columns=self.get_categorical_columns(), csv_engine=self.csv_engine)
+        while True:
+            with self.metrics.stage("parse"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def is_capped(self) -> bool:
+        return self.max_levels is not None or self.max_cardinality is not None
+
+    def summarize_data(self):
+        # one summary over all input files
+        from app.algo import IncrementalCombiner, top_counts
+
+        if len(self.input_filenames) == 1:
+            return self.summarize_file(self.input_filenames[0])
+
+        combiner = IncrementalCombiner()
+        for filename in self.input_filenames:
+            combiner.add(self.summarize_file(filename))
+        if not self.is_capped():
+            return combiner.result()
+        limit = self.get_local_levels_limit()
+        return {column_name: top_counts(dict(counts), limit) for column_name, counts in combiner.counts.items()}
+
+    def summarize_file(self, filename: str):
+        # with a cardinality cap the summary holds the counts of the categories instead of only the categories
+        from pandas.api.types import pandas_dtype
+        from app.algo import CategoryDiscovery, top_counts
+
+        cached = self.get_cached_summary(filename)
+        if cached is not None:
+            summary, self.mixed_columns[filename], column_dtypes = cached
+            if column_dtypes is not None:
+                # dtypes are stored by name
+                self.column_dtypes[filename] = {column_name: pandas_dtype(dtype)
+                                                for column_name, dtype in column_dtypes.items()}
+            return summary
+
+        capped = self.is_capped()
+        discovery = CategoryDiscovery(self.max_cardinality, counts=capped)
+        if self.chunksize is None:
+            if filename not in self.data:
+                self.data[filename] = self.read_data(filename)
+            discovery.update(self.data[filename])
+        else:
+            self.summarize_chunks(filename, discovery)
+        summary = discovery.result()
+        logging.info(f"Found {len(summary)} categorical columns in {filename}"
+                     + (f", {len(discovery.exceeded)} with more than {self.max_cardinality} categories"
+                        if discovery.exceeded else ""))
+        logging.debug("Distinct categories per column: %s", Lazy(lambda: preview(discovery.distinct_counts())))
+
+        if capped:
+            limit = self.get_local_levels_limit()
+            summary = {column_name: top_counts(counts, limit) for column_name, counts in summary.items()}
+        if self.cache is not None:
+            # the column types collected by the first pass of the streaming mode are stored along with the summary
+            column_dtypes = self.column_dtypes.get(filename)
+            if column_dtypes is not None:
+                column_dtypes = {column_name: str(dtype) for column_name, dtype in column_dtypes.items()}
+            self.cache.put_summary(self.get_cache_key(filename),
+                                   (summary, self.mixed_columns.get(filename, set()), column_dtypes))
+        return summary
+
+    def summarize_chunks(self, filename: str, discovery: "CategoryDiscovery"):
+        from app.formats import common_dtype
+
+        # first pass: collect the categories chunk by chunk
+        object_columns = set()
+        other_dtypes: Dict[str, Set[Any]] = {}
+        for chunk in self.iter_data(filename):
+            chunk_columns = discovery.update(chunk)
+            object_columns.update(chunk_columns)
+            for column_name in set(chunk.columns).difference(chunk_columns):
+                other_dtypes.setdefault(column_name, set()).add(chunk.dtypes[column_name])
+
+        # columns that were only parsed as strings in some chunks are rescanned as strings, as a full read would do
+        mixed_columns = object_columns.intersection(other_dtypes)
+        self.mixed_columns[filename] = mixed_columns
+        self.column_dtypes[filename] = {column_name: common_dtype(dtypes)
+                                        for column_name, dtypes in other_dtypes.items()
+                                        if column_name not in mixed_columns}
+        if mixed_columns:
+            logging.info(f"Rescan columns with mixed types: {mixed_columns}")
+            # the rescan collects every value again
+            for column_name in mixed_columns:
+                discovery.discard(column_name)
+            for chunk in self.iter_data(filename, columns=list(mixed_columns),
+                                        dtype={column_name: str for column_name in mixed_columns}):
+                discovery.update(chunk)
+
+    def get_column_dtypes(self, filename: str) -> Dict[str, Any]:
+        # streaming mode: every chunk is read with the dtypes the passed through columns have over the whole file, so
+        # they have the same type in every chunk of the output. In auto mode they are collected by the first pass,
+        # otherwise the file is scanned for them if the output format stores the column types
+        if filename not in self.column_dtypes:
+            if self.output_format == "csv":
+                return {}
+            self.column_dtypes[filename] = self.scan_column_dtypes(filename)
+        return self.column_dtypes[filename]
+
+    def scan_column_dtypes(self, filename: str) -> Dict[str, Any]:
+        from app.formats import common_dtype
+
+        logging.info(f"Scan the column types of {filename}")
+        dtypes: Dict[str, Set[Any]] = {}
+        for chunk in self.iter_data(filename):
+            for column_name, dtype in chunk.dtypes.items():
+                if self.plan is None or column_name not in self.plan:
+                    dtypes.setdefault(column_name, set()).add(dtype)
+        return {column_name: common_dtype(column_dtypes) for column_name, column_dtypes in dtypes.items()
+                if column_name not in self.mixed_columns.get(filename, set())}
+
+    def get_local_levels_limit(self) -> int:
+        # the summaries hold the counts of a bounded number of categories per column: enough to tell whether a
+        # column exceeds max_cardinality and to approximate the global max_levels most frequent categories
+        limits = []
+        if self.max_cardinality is not None:
+            limits.append(self.max_cardinality + 1)
+        if self.max_levels is not None:
+            limits.append(LOCAL_LEVELS_FACTOR * self.max_levels)
+        return max(limits)
+
+    def get_output_filename(self, input_filename: str) -> str:
+        # {name} and {stem} in the output filename are replaced by the name of the input file with and without its
+        # extension, which is required when there are several input files
+        name = os.path.basename(input_filename)
+        return self.output_filename.replace("{name}", name).replace("{stem}", os.path.splitext(name)[0])
+
+    def encode(self, data, codes, workers: int):
+        # encode a table from which the rows with unknown categories have been dropped
+        from app.encode import encode_categorical, encode_ordinal, INDICATOR_DTYPES
+
+        if self.encoding == "ordinal":
+            return encode_ordinal(data, self.plan, codes=codes, workers=workers)
+        return encode_categorical(data, self.plan, sparse=self.sparse, dtype=INDICATOR_DTYPES[self.dtype],
+                                  codes=codes, workers=workers)
+
     def encode_data(self):
-        logging.info(f"Encode data")
-        encoded_df = encode_categorical(self.data, self.aggregated_col_info)
-        self.encoded_data = drop_rows_with_introduced_na_values(self.data, encoded_df)
-        logging.debug(f"Column names:\t{self.encoded_data.columns}")
+        # encode and write every input file, several files are encoded in parallel by a pool of workers and the
+        # remaining workers encode the columns of a file in parallel
+        n_parallel = max(1, min(self.workers, len(self.input_filenames)))
+        workers = max(1, self.workers // n_parallel)
+        if n_parallel == 1:
+            for filename in self.input_filenames:
+                self.encode_file(filename, workers)
+            return
+
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+            list(executor.map(lambda filename: self.encode_file(filename, workers), self.input_filenames))
+
+    def decode(self, data, workers: int):
+        from app.encode import decode_categorical, decode_ordinal
+
+        if self.encoding == "ordinal":
+            return decode_ordinal(data, self.plan, workers=workers)
+        return decode_categorical(data, self.plan, workers=workers)
+
+    def encode_file(self, filename: str, workers: int):
+        path = os.path.join(self.OUTPUT_DIR, self.get_output_filename(filename))
+        if self.chunksize is not None:
+            self.encode_and_write_chunked(filename, path, workers)
+            return
+
+        from app.algo import drop_rows_with_unknown_categories
+
+        data = self.data.pop(filename, None)
+        if data is None:
+            data = self.read_data(filename)
+        if self.mode == "decode":
+            logging.info(f"Decode {filename}")
+            with self.metrics.stage("decode"):
+                decoded_data = self.decode(data, workers)
+            self.metrics.add_rows(len(data), len(decoded_data))
+            del data
+            self.write_output(decoded_data, path)
+            return
+
+        logging.info(f"Encode {filename}")
+        with self.metrics.stage("filter unknown rows"):
+            filtered_data, codes = drop_rows_with_unknown_categories(data, self.plan, workers=workers,
+                                                                          ordinal=self.encoding == "ordinal")
+        logging.info(f"Dropped {len(data) - len(filtered_data)} rows with unknown categories")
+        self.metrics.add_rows(len(data), len(filtered_data))
+        with self.metrics.stage("encode"):
+            encoded_data = self.encode(filtered_data, codes, workers)
+        logging.debug("Column names:\t%s", Lazy(lambda: preview(list(encoded_data.columns))))
+        if self.sparse and self.encoding == "onehot":
+            self.log_sparse_memory_usage(data, encoded_data)
+        del data, filtered_data, codes
+        self.write_output(encoded_data, path)
+
+    def log_sparse_memory_usage(self, data, encoded_data):
+        # compare the sparse indicator columns with the matrix the dense path would have allocated
+        import numpy
+        from app.encode import INDICATOR_DTYPES
+
+        new_columns = encoded_data.columns.difference(data.columns)
+        sparse_bytes = encoded_data[new_columns].memory_usage(index=False).sum()
+        dense_bytes = len(encoded_data) * len(new_columns) * numpy.dtype(INDICATOR_DTYPES[self.dtype]).itemsize
+        logging.info(f"Sparse indicator columns use {sparse_bytes / 2 ** 20:.2f} MiB instead of "
+                     f"{dense_bytes / 2 ** 20:.2f} MiB (saved {(dense_bytes - sparse_bytes) / 2 ** 20:.2f} MiB)")
+
+    def get_indicator_columns(self) -> List[str]:
+        return [name for names in self.plan.names.values() for name in names]
+
+    def get_output_dtypes(self) -> Dict[str, Any]:
+        # the dtype of the indicator columns follows from the plan, independent of the values of a chunk
+        from app.encode import INDICATOR_DTYPES
+
+        if self.mode == "decode" or self.encoding != "onehot":
+            return {}
+        dtype = INDICATOR_DTYPES[self.dtype]
+        return {name: dtype for name in self.get_indicator_columns()}
+
+    def write_output(self, encoded_data, path):
+        from app.formats import write_table
 
-    def write_output(self, path):
         logging.info(f"Write data to {path}")
-        self.encoded_data.to_csv(path, sep=self.sep, index=False)
+        with self.metrics.stage("write"):
+            write_table(encoded_data, path, self.output_format, sep=self.sep, csv_writer=self.csv_writer,
+                        indicator_columns=self.get_indicator_columns(), dtypes=self.get_output_dtypes())
+
+    def encode_and_write_chunked(self, filename: str, path, workers: int):
+        # second pass: encode every chunk with the aggregated levels and append it to the output file
+        from app.algo import drop_rows_with_unknown_categories
+        from app.formats import TableWriter
+
+        logging.info(f"Encode data and write it to {path}")
+        n_rows_in = 0
+        n_rows_out = 0
+        dtype = dict(self.get_column_dtypes(filename))
+        dtype.update({column_name: str for column_name in self.mixed_columns.get(filename, set())})
+        with TableWriter(path, self.output_format, sep=self.sep, csv_writer=self.csv_writer,
+                         indicator_columns=self.get_indicator_columns(), dtypes=self.get_output_dtypes()) as writer:
+            for chunk in self.iter_data(filename, dtype=dtype):
+                if self.mode == "decode":
+                    with self.metrics.stage("decode"):
+                        decoded_chunk = self.decode(chunk, workers)
+                    with self.metrics.stage("write"):
+                        writer.write(decoded_chunk)
+                    self.metrics.add_rows(len(chunk), len(decoded_chunk))
+                    continue
+                with self.metrics.stage("filter unknown rows"):
+                    data, codes = drop_rows_with_unknown_categories(chunk, self.plan, workers=workers,
+                                                                     ordinal=self.encoding == "ordinal")
+                with self.metrics.stage("encode"):
+                    encoded_chunk = self.encode(data, codes, workers)
+                with self.metrics.stage("write"):
+                    writer.write(encoded_chunk)
+                n_rows_in += len(chunk)
+                n_rows_out += len(encoded_chunk)
+                self.metrics.add_rows(len(chunk), len(encoded_chunk))
+        logging.info(f"Dropped {n_rows_in - n_rows_out} rows with unknown categories")
+
+    def write_run_summary(self):
+        path = os.path.join(self.OUTPUT_DIR, RUN_SUMMARY_FILENAME)
+        self.metrics.save(path)
+        metrics = self.metrics.to_dict()
+        logging.info("Time per step: " + ", ".join(f"{step} {duration:.3f}s"
+                                                   for step, duration in metrics["state_durations"].items()))
+        logging.info("Time per stage: " + ", ".join(f"{stage} {duration:.3f}s"
+                                                    for stage, duration in metrics["stage_durations"].items()))
+        logging.info(f"Wrote run summary to {path}")
+
+    def build_plan(self):
+        # compile the aggregated column information once and store it next to the outputs for later runs
+        from app.plan import EncodingPlan, PLAN_FILENAME
+
+        self.plan = EncodingPlan(self.aggregated_col_info)
+        path = os.path.join(self.OUTPUT_DIR, PLAN_FILENAME)
+        logging.info(f"Write encoding plan to {path}")
+        self.plan.save(path)
+
+    def start_merger(self):
+        # summaries that arrive from now on are decoded and merged right away instead of being buffered
+        from app.merger import BackgroundMerger
+
+        def on_processed():
+            with self.condition:
+                self.notify()
+
+        with self.condition:
+            self.merger = BackgroundMerger(self.decode_payload, on_processed)
+            for payload in self.take_incoming():
+                self.merger.submit(payload)
+
+    def get_agreed_mode(self) -> str:
+        # the mode and all settings of it the nodes must agree on before the first round
+        if self.mode in PLAN_MODES:
+            # all nodes must use the same plan
+            return f"{self.mode}:{self.plan.fingerprint}"
+        if self.mode == "auto" and self.is_capped():
+            # the local summaries and their aggregation depend on the caps
+            return f"{self.mode}:max_levels={self.max_levels}:max_cardinality={self.max_cardinality}"
+        return self.mode
 
     @staticmethod
     def check_agree(data: List[str]):
         return len(set(data)) == 1
 
+    @staticmethod
+    def load_data_stack():
+        start = time.perf_counter()
+        import yaml
+        import app.algo
+        import app.formats
+        import app.merger
+        logging.info(f"Loaded data stack in {time.perf_counter() - start:.3f}s")
+
     def app_flow(self):
         # This method contains a state machine for the participant and coordinator instance
+        self.load_data_stack()
 
         # === States ===
         state_initializing = 1
@@ -159,9 +722,11 @@ class AppLogic:
         # Initial state
         state = state_initializing
         while True:
+            events = self.events
+            previous_state = state
 
             if state == state_initializing:
-                self.progress = "initializing..."
+                self.set_progress("initializing...")
                 print("[CLIENT] Initializing...", flush=True)
                 if self.id is not None:  # Test is setup has happened already
                     if self.coordinator:
@@ -172,7 +737,7 @@ class AppLogic:
                 print("[CLIENT] Initializing finished.", flush=True)
 
             if state == state_read_config:
-                self.progress = "read config..."
+                self.set_progress("read config...")
                 print("[CLIENT] Read config...", flush=True)
                 # Read the config file
                 self.read_config()
@@ -180,22 +745,21 @@ class AppLogic:
                 print("[CLIENT] Read config finished.", flush=True)
 
             if state == state_send_mode:
-                self.progress = "send mode..."
+                self.set_progress("send mode...")
                 print("[CLIENT] Send mode...", flush=True)
-                mode = self.mode
+                mode = self.get_agreed_mode()
                 logging.debug(f"mode:\t{mode}")
                 # Encode local results to send it to coordinator
-                data_to_send = jsonpickle.encode(mode)
+                data_to_send = self.encode_payload(mode)
 
                 if self.coordinator:
                     # if the client is the coordinator: add the local results directly to the data_incoming array
-                    self.data_incoming.append(data_to_send)
+                    self.add_incoming(data_to_send)
                     # go to state where the coordinator is waiting for the local results and aggregates them
                     state = state_global_check_mode_agreement
                 else:
                     # if the client is not the coordinator: set data_outgoing and set status_available to true
-                    self.data_outgoing = data_to_send
-                    self.status_available = True
+                    self.send(data_to_send)
                     # go to state where the client is waiting for the aggregated results
                     state = state_wait_for_mode_agreement
                     print('[CLIENT] Send mode to coordinator', flush=True)
@@ -203,92 +767,95 @@ class AppLogic:
 
             # GLOBAL AGGREGATION
             if state == state_global_check_mode_agreement:
-                self.progress = "aggregate mode information..."
+                self.set_progress("aggregate mode information...")
                 print("[COORDINATOR] Aggregate mode information...", flush=True)
-                if len(self.data_incoming) == len(self.clients):
+                if self.count_incoming() == len(self.clients):
                     print("[COORDINATOR] Received mode of all participants.", flush=True)
                     print("[COORDINATOR] Checking agreement on mode...", flush=True)
-                    # Decode received data of each client
-                    data = [jsonpickle.decode(client_data) for client_data in self.data_incoming]
-                    # Empty the incoming data (important for multiple iterations)
-                    self.data_incoming = []
+                    # Decode received data of each client and empty the incoming data
+                    data = [self.decode_payload(client_data) for client_data in self.take_incoming()]
                     # Perform global aggregation
                     agreement = self.check_agree(data)
                     logging.debug(f"agreement:\t{agreement}")
                     # Encode aggregated results for broadcasting
-                    data_to_broadcast = jsonpickle.encode(agreement)
+                    data_to_broadcast = self.encode_payload(agreement)
 
-                    # Fill data_outgoing
-                    self.data_outgoing = data_to_broadcast
-                    # Set available to True such that the data will be broadcasted
-                    self.status_available = True
+                    # Fill data_outgoing and set available to True such that the data will be broadcasted
+                    self.send(data_to_broadcast)
                     # go to state where the client is waiting for the aggregated results
 
                     if not agreement:
                         state = state_finish
                     else:
+                        if self.mode not in PLAN_MODES:
+                            self.round = "aggregation"
+                            self.start_merger()
                         state = state_read_input
                     print("[COORDINATOR] Checking agreement on mode finished.", flush=True)
-                    time.sleep(10)
                 else:
                     print(
-                        f"[COORDINATOR] Mode information of {str(len(self.clients) - len(self.data_incoming))} client(s) still "
-                        f"missing...)", flush=True)
+                        f"[COORDINATOR] Mode information of {str(len(self.clients) - self.count_incoming())} "
+                        f"client(s) still missing...)", flush=True)
 
             if state == state_wait_for_mode_agreement:
-                self.progress = "wait for mode agreement information..."
+                self.set_progress("wait for mode agreement information...")
                 print("[CLIENT] Wait for mode agreement information...", flush=True)
                 # Wait until received broadcast data from coordinator
-                if len(self.data_incoming) > 0:
+                if self.count_incoming() > 0:
                     print("[CLIENT] Process aggregated result from coordinator...", flush=True)
-                    # Decode broadcasted data
-                    agreement = jsonpickle.decode(self.data_incoming[0])
+                    # Decode broadcasted data and empty incoming data
+                    agreement = self.decode_payload(self.take_incoming()[0])
                     logging.debug(f"agreement:\t{agreement}")
                     logging.debug(f"mode:\t{self.mode}")
-                    # Empty incoming data
-                    self.data_incoming = []
 
                     if not agreement:
                         raise ValueError("Participants do not agree on mode")
+                    self.round = "aggregation"
 
                     # Go to nex state (finish)
                     state = state_read_input
                     print("[CLIENT] Mode agreement finished.", flush=True)
 
             if state == state_read_input:
-                self.progress = "read input..."
+                self.set_progress("read input...")
                 print("[CLIENT] Read input...", flush=True)
-                # read input files
-                self.data = self.read_data()
-                state = state_summarize_columns
+                # read input files, in streaming mode the data is read chunk-wise later on.
+                # In predefined and plan mode, and in auto mode with a cached summary, the data is only needed for
+                # encoding, it is read once the levels are known
+                if self.chunksize is None and self.mode == "auto":
+                    for filename in self.input_filenames:
+                        if self.get_cached_summary(filename) is None:
+                            self.data[filename] = self.read_data(filename)
+                if self.mode in PLAN_MODES:
+                    state = state_encode_data
+                else:
+                    state = state_summarize_columns
                 print("[CLIENT] Read input finished.", flush=True)
 
             if state == state_summarize_columns:
                 if self.mode == "auto":
-                    self.progress = "summarize columns..."
+                    self.set_progress("summarize columns...")
                     print("[CLIENT] Summarize columns...", flush=True)
 
                     # Compute local results
-                    columns_summary = get_categories(self.data)
+                    columns_summary = self.summarize_data()
                 else:
                     if self.coordinator:
                         columns_summary = self.study_definition
                     else:
                         columns_summary = None  # send None when predefined mode and node is not coordinator
 
-                logging.debug(f"columns_summary:\t{columns_summary}")
-                # Encode local results to send it to coordinator
-                data_to_send = jsonpickle.encode(columns_summary)
+                logging.debug("columns_summary:\t%s", Lazy(preview, columns_summary))
 
                 if self.coordinator:
-                    # if the client is the coordinator: add the local results directly to the data_incoming array
-                    self.data_incoming.append(data_to_send)
+                    # if the client is the coordinator: add the local results directly to the merger
+                    self.merger.add(columns_summary)
                     # go to state where the coordinator is waiting for the local results and aggregates them
                     state = state_global_aggregate_col_info
                 else:
-                    # if the client is not the coordinator: set data_outgoing and set status_available to true
-                    self.data_outgoing = data_to_send
-                    self.status_available = True
+                    # if the client is not the coordinator: encode the local results, set data_outgoing and set
+                    # status_available to true
+                    self.send(self.encode_payload(columns_summary))
                     # go to state where the client is waiting for the aggregated results
                     state = state_wait_for_aggregation
                     print('[CLIENT] Send data to coordinator', flush=True)
@@ -296,77 +863,72 @@ class AppLogic:
 
             # GLOBAL AGGREGATION
             if state == state_global_aggregate_col_info:
-                self.progress = "aggregate column information..."
+                self.set_progress("aggregate column information...")
                 print("[COORDINATOR] Aggregate column information...", flush=True)
-                if len(self.data_incoming) == len(self.clients):
+                if self.merger.processed == len(self.clients):
                     print("[COORDINATOR] Received data of all participants.", flush=True)
                     print("[COORDINATOR] Merging results...", flush=True)
-                    # Decode received data of each client
-                    data = [jsonpickle.decode(client_data) for client_data in self.data_incoming]
-                    # Empty the incoming data (important for multiple iterations)
-                    self.data_incoming = []
-                    # Perform global aggregation
+                    # The summaries have already been merged on arrival, only the result is collected
                     if self.mode == "auto":
-                        self.aggregated_col_info = combine(data)
-                        logging.debug(f"combined:\t{self.aggregated_col_info}")
+                        self.aggregated_col_info = self.merger.finalize(max_levels=self.max_levels,
+                                                                        max_cardinality=self.max_cardinality)
+                        logging.debug("combined:\t%s", Lazy(preview, self.aggregated_col_info))
                     else:
                         # wait for other nodes to send something but ignore and return predefined
+                        self.merger.finalize()
                         self.aggregated_col_info = self.study_definition
+                    self.merger = None
+                    self.build_plan()
                     # Encode aggregated results for broadcasting
-                    data_to_broadcast = jsonpickle.encode(self.aggregated_col_info)
-                    # Fill data_outgoing
-                    self.data_outgoing = data_to_broadcast
-                    # Set available to True such that the data will be broadcasted
-                    self.status_available = True
+                    data_to_broadcast = self.encode_payload(self.aggregated_col_info)
+                    # Fill data_outgoing and set available to True such that the data will be broadcasted
+                    self.send(data_to_broadcast)
                     state = state_encode_data
                     print("[COORDINATOR] Global aggregation finished.", flush=True)
                 else:
                     print(
-                        f"[COORDINATOR] Data of {str(len(self.clients) - len(self.data_incoming))} client(s) still "
+                        f"[COORDINATOR] Data of {str(len(self.clients) - self.merger.processed)} client(s) still "
                         f"missing...)", flush=True)
 
             if state == state_wait_for_aggregation:
-                self.progress = "wait for aggregated results..."
+                self.set_progress("wait for aggregated results...")
                 print("[CLIENT] Wait for aggregated results from coordinator...", flush=True)
                 # Wait until received broadcast data from coordinator
-                if len(self.data_incoming) > 0:
+                if self.count_incoming() > 0:
                     print("[CLIENT] Process aggregated result from coordinator...", flush=True)
-                    # Decode broadcasted data
-                    self.aggregated_col_info = jsonpickle.decode(self.data_incoming[0])
-                    logging.debug(self.aggregated_col_info)
-                    logging.debug(encode_categorical(self.data, self.aggregated_col_info))
-                    # Empty incoming data
-                    self.data_incoming = []
+                    # Decode broadcasted data and empty incoming data
+                    self.aggregated_col_info = self.decode_payload(self.take_incoming()[0])
+                    logging.debug("aggregated:\t%s", Lazy(preview, self.aggregated_col_info))
+                    self.build_plan()
                     # Go to nex state (finish)
                     state = state_encode_data
                     print("[CLIENT] Processing aggregated results finished.", flush=True)
 
             if state == state_encode_data:
-                self.progress = "encode data..."
+                self.set_progress("encode data...")
                 print("[CLIENT] Encode data...", flush=True)
+                # every file is written as soon as it is encoded
                 self.encode_data()
                 state = state_finish
                 print("[CLIENT] Encode data finished.", flush=True)
 
             if state == state_finish:
-                self.progress = "finishing..."
+                self.set_progress("finishing...")
                 print("[CLIENT] FINISHING", flush=True)
 
-                # Write results
-                logging.info(f"Writing final results...")
-                output_path = os.path.join(self.OUTPUT_DIR, self.output_filename)
-                self.write_output(output_path)
+                # Make sure the last broadcast has been picked up before finishing
+                self.wait_until_sent()
 
-                # Wait some seconds to make sure all clients have written the results. This will be fixed soon.
-                if self.coordinator:
-                    time.sleep(5)
+                self.set_progress("finished.")
+                self.write_run_summary()
 
                 # Set finished flag to True, which ends the computation
-                self.status_finished = True
-                self.progress = "finished."
+                self.finish()
                 break
 
-            time.sleep(1)
+            if state == previous_state:
+                # nothing to do until data arrives or is picked up
+                self.wait_for_event(events)
 
 
 logic = AppLogic()
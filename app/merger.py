@@ -0,0 +1,56 @@
+import logging
+import queue
+import threading
+from typing import Callable, Optional, Union, IO
+
+from app.algo import IncrementalCombiner
+
+_STOP = object()
+
+
+class BackgroundMerger:
+    # Decodes the payloads of the clients on a worker thread and folds them into a running combination as soon as
+    # they arrive, instead of decoding and merging all of them once the last client has sent its data.
+    # The raw payloads are dropped right after decoding.
+
+    def __init__(self, decode: Callable[[Union[bytes, IO[bytes]]], object],
+                 on_processed: Optional[Callable[[], None]] = None):
+        self.decode = decode
+        self.on_processed = on_processed
+        self.combiner = IncrementalCombiner()
+        self.processed = 0
+        self.error: Optional[BaseException] = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, payload: Union[bytes, IO[bytes]]):
+        self.queue.put(payload)
+
+    def add(self, data):
+        # add data that does not need to be decoded, e.g. the local summary of the coordinator
+        self.queue.put((data,))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            try:
+                data = item[0] if isinstance(item, tuple) else self.decode(item)
+                del item
+                self.combiner.add(data)
+            except BaseException as e:
+                logging.exception("Merging client data failed")
+                self.error = e
+            self.processed += 1
+            if self.on_processed is not None:
+                self.on_processed()
+
+    def finalize(self, **kwargs):
+        # kwargs are passed on to IncrementalCombiner.result
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.combiner.result(**kwargs)
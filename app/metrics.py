@@ -0,0 +1,90 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+RUN_SUMMARY_FILENAME = "run_summary.json"
+
+
+def peak_rss() -> int:
+    # peak resident set size of the process in bytes, ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Metrics:
+    # Timings, row counts, traffic and memory of a run. States are the steps of the app flow (including the
+    # time spent waiting on other nodes), stages are the parts of the local computation inside of them:
+    # parsing, filtering rows with unknown categories, encoding and writing.
+    # Updated from the app flow and the server threads, read by the metrics route.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.state_durations: Dict[str, float] = {}
+        self.stage_durations: Dict[str, float] = {}
+        # peak RSS of the process at the end of every state
+        self.state_peak_rss: Dict[str, int] = {}
+        self.rows_in = 0
+        self.rows_out = 0
+        # bytes sent and received per round of communication
+        self.traffic: Dict[str, Dict[str, int]] = {}
+        self.state: Optional[str] = None
+        self.state_started: Optional[float] = None
+
+    def enter_state(self, state: str):
+        now = time.monotonic()
+        with self.lock:
+            if self.state is not None:
+                self.state_durations[self.state] = self.state_durations.get(self.state, 0.0) + now - self.state_started
+                self.state_peak_rss[self.state] = peak_rss()
+            self.state = state
+            self.state_started = now
+
+    @contextmanager
+    def stage(self, name: str):
+        # durations of a stage run several times, e.g. once per chunk, are summed up
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.stage_durations[name] = self.stage_durations.get(name, 0.0) + duration
+
+    def add_rows(self, rows_in: int, rows_out: int):
+        with self.lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+
+    def add_traffic(self, round_name: str, sent: int = 0, received: int = 0):
+        with self.lock:
+            traffic = self.traffic.setdefault(round_name, {"sent": 0, "received": 0})
+            traffic["sent"] += sent
+            traffic["received"] += received
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            state_durations = dict(self.state_durations)
+            if self.state is not None:
+                # include the time spent in the current state so far
+                state_durations[self.state] = state_durations.get(self.state, 0.0) + time.monotonic() - \
+                                              self.state_started
+            return {
+                "started": self.started,
+                "elapsed": time.time() - self.started,
+                "state": self.state,
+                "state_durations": state_durations,
+                "stage_durations": dict(self.stage_durations),
+                "rows": {"in": self.rows_in, "out": self.rows_out, "dropped": self.rows_in - self.rows_out},
+                "traffic": {round_name: dict(traffic) for round_name, traffic in self.traffic.items()},
+                "state_peak_rss": dict(self.state_peak_rss),
+                "peak_rss": peak_rss(),
+            }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,86 @@
+import hashlib
+from typing import Dict, Set, List, Union, Iterable
+
+import numpy
+import pandas
+
+from app import codec
+
+PLAN_FILENAME = "encoding_plan.bin"
+# version of the stored plan, which only holds the levels, all other attributes are derived from them on load
+PLAN_VERSION = 1
+# level of the bucket all values are mapped to that are not among the levels of a capped column
+OTHER_LEVEL = "__other__"
+
+
+def sort_levels(values) -> list:
+    # the other bucket always comes last, so it is never the dropped first level
+    levels = sorted(value for value in values if value != OTHER_LEVEL)
+    if OTHER_LEVEL in values:
+        levels.append(OTHER_LEVEL)
+    return levels
+
+
+class EncodingPlan:
+    # Compiled form of the aggregated column information, built once after the aggregation and reused for every
+    # encode call: ordered levels, the categorical dtypes used to look up codes, output names and widths.
+
+    def __init__(self, levels: Dict[str, Union[Set[Union[str, int]], List[Union[str, int]]]]):
+        self.levels: Dict[str, List[Union[str, int]]] = {name: sort_levels(values) for name, values in levels.items()}
+        self.categorical_dtypes: Dict[str, pandas.CategoricalDtype] = {
+            name: pandas.CategoricalDtype(values) for name, values in self.levels.items()
+        }
+        # the first level is dropped, columns with a single level are passed through unchanged
+        self.names: Dict[str, List[str]] = {
+            name: ["{}={}".format(name, level) for level in values[1:]] for name, values in self.levels.items()
+        }
+        self.widths: Dict[str, int] = {name: len(names) for name, names in self.names.items()}
+        # codes of the other bucket of capped columns, unknown values of these columns are mapped to it
+        self.other_codes: Dict[str, int] = {
+            name: len(values) - 1 for name, values in self.levels.items() if OTHER_LEVEL in values
+        }
+        self.fingerprint = hashlib.sha256(repr(sorted(self.levels.items())).encode()).hexdigest()
+
+    def __contains__(self, name) -> bool:
+        return name in self.levels
+
+    def keys(self):
+        return self.levels.keys()
+
+    def __getitem__(self, name) -> List[Union[str, int]]:
+        return self.levels[name]
+
+    def __repr__(self):
+        return f"EncodingPlan({self.levels!r})"
+
+    def offsets(self, columns: Iterable[str]) -> Dict[str, int]:
+        # offsets of the indicator columns of the given columns in a buffer holding them in this order
+        names = [name for name in columns if name in self.levels]
+        offsets = numpy.concatenate([[0], numpy.cumsum([self.widths[name] for name in names], dtype=numpy.int64)])
+        return dict(zip(names, offsets[:-1].tolist()))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(codec.dumps({"version": PLAN_VERSION, "levels": self.levels}))
+
+    @staticmethod
+    def load(path) -> "EncodingPlan":
+        with open(path, "rb") as f:
+            payload = f.read()
+        try:
+            stored = codec.loads(payload)
+        except ValueError:
+            # also plans pickled by earlier versions, which are not loaded as unpickling can execute code
+            raise ValueError(f"{path} does not contain an encoding plan")
+        if not isinstance(stored, dict) or not isinstance(stored.get("levels"), dict):
+            raise ValueError(f"{path} does not contain an encoding plan")
+        if stored.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported encoding plan version {stored.get('version')} in {path}, "
+                             f"expected {PLAN_VERSION}")
+        return EncodingPlan(stored["levels"])
+
+
+def compile_plan(levels) -> EncodingPlan:
+    if isinstance(levels, EncodingPlan):
+        return levels
+    return EncodingPlan(levels)
@@ -0,0 +1,24 @@
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from bottle import ServerAdapter
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # every request is handled on its own thread, so a long-polling status request does not block the data routes
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ThreadedServer(ServerAdapter):
+    # Threaded variant of Bottle's default wsgiref server, which handles one request at a time
+
+    def run(self, app):
+        handler = QuietHandler if self.quiet else WSGIRequestHandler
+        server = make_server(self.host, self.port, app, ThreadingWSGIServer, handler)
+        self.port = server.server_port
+        server.serve_forever()
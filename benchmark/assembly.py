@@ -0,0 +1,60 @@
+# Memory benchmark of the output assembly in encode_categorical.
+# Compares the preallocated buffer against the previous path, which built every block with numpy.eye(k).take,
+# sliced off the first level and concatenated the blocks.
+#
+# Usage: python -m benchmark.assembly [--rows N] [--columns N] [--levels N]
+import argparse
+import time
+import tracemalloc
+
+import numpy
+import pandas
+
+from app.encode import encode_categorical
+from benchmark.data import generate_table
+
+
+def legacy_encode_categorical(table: pandas.DataFrame, levels):
+    items = []
+    for name, series in table.items():
+        if name in levels and len(levels[name]) > 1:
+            levels_for_series = sorted(levels[name])
+            cat = pandas.Categorical(series, categories=levels_for_series)
+            dummy_mat = numpy.eye(len(levels_for_series)).take(cat.codes, axis=0)
+            dummy_mat[cat.codes == -1] = numpy.nan
+            names = ["{}={}".format(name, level) for level in levels_for_series[1:]]
+            series = pandas.DataFrame(dummy_mat[:, 1:], columns=names, index=series.index)
+        items.append(series)
+    return pandas.concat(items, axis=1, copy=False)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output_bytes = result.memory_usage(index=False).sum()
+    del result
+    return duration, peak, output_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--columns", type=int, default=5)
+    parser.add_argument("--levels", type=int, default=50)
+    args = parser.parse_args()
+
+    table, levels = generate_table(args.rows, args.columns, cardinality=args.levels)
+    print(f"{args.rows} rows, {args.columns} categorical columns with {args.levels} levels each")
+    print(f"{'path':<12}{'time [s]':>10}{'peak [MiB]':>12}{'output [MiB]':>14}{'overhead':>10}")
+    for label, func in [("legacy", legacy_encode_categorical), ("buffer", encode_categorical)]:
+        duration, peak, output_bytes = measure(func, table, levels)
+        print(f"{label:<12}{duration:>10.3f}{peak / 2 ** 20:>12.1f}{output_bytes / 2 ** 20:>14.1f}"
+              f"{peak / output_bytes:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
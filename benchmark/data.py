@@ -0,0 +1,29 @@
+# Synthetic tables for the benchmarks
+from typing import Dict, List, Tuple
+
+import numpy
+import pandas
+
+
+def generate_table(n_rows: int, n_categorical: int = 5, n_numeric: int = 1, cardinality: int = 50,
+                   na_rate: float = 0.0, unknown_fraction: float = 0.0,
+                   seed: int = 0) -> Tuple[pandas.DataFrame, Dict[str, List[str]]]:
+    # Returns a table with n_categorical string columns of the given cardinality and n_numeric float columns,
+    # and the levels to encode it with. A share of na_rate of the categorical values is missing, a share of
+    # unknown_fraction is set to a level that is not part of the returned levels.
+    rng = numpy.random.default_rng(seed)
+    values = numpy.array([f"level{i}" for i in range(cardinality)], dtype=object)
+
+    table = {}
+    levels = {}
+    for i in range(n_categorical):
+        name = f"cat{i}"
+        column = values[rng.integers(0, cardinality, n_rows)]
+        column[rng.random(n_rows) < unknown_fraction] = "unknown"
+        column[rng.random(n_rows) < na_rate] = numpy.nan
+        table[name] = column
+        levels[name] = list(values)
+    for i in range(n_numeric):
+        table[f"num{i}"] = rng.normal(size=n_rows)
+
+    return pandas.DataFrame(table), levels
@@ -0,0 +1,137 @@
+# End-to-end benchmark of a federated run in a single process: a stand-in for the FeatureCloud controller runs one
+# AppLogic per site on synthetic data and relays the payloads between them, including mode agreement, aggregation
+# and broadcast. Reports the latency and bytes of every round of communication and the total time per run.
+#
+# Usage: python -m benchmark.federation [--sites 2 10 50] [--rows N] [--categorical N] [--cardinality N]
+#                                       [--mode auto|predefined] [--output results.json] [--verbose]
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import List, Tuple, Dict, Optional
+
+import yaml
+
+from app.logic import AppLogic
+from benchmark.data import generate_table
+
+
+class LocalController:
+    # Relays the data between AppLogic instances like the controller does between the containers: the data of the
+    # participants is sent to the coordinator, the data of the coordinator is broadcast to all participants.
+    # The first site is the coordinator.
+
+    def __init__(self, directories: List[Tuple[str, str]], poll_interval: float = 0.001):
+        self.nodes = [AppLogic(input_dir, output_dir) for input_dir, output_dir in directories]
+        self.poll_interval = poll_interval
+        self.rounds: Dict[str, Dict] = {}
+
+    def record(self, round_name: str, n_bytes: int, n_messages: int, broadcast: bool):
+        now = time.perf_counter()
+        stats = self.rounds.setdefault(round_name, {"start": now, "end": now, "bytes_up": 0, "bytes_down": 0,
+                                                    "messages": 0})
+        stats["end"] = now
+        stats["bytes_down" if broadcast else "bytes_up"] += n_bytes * n_messages
+        stats["messages"] += n_messages
+
+    def relay(self, index: int, node: AppLogic):
+        data = node.handle_outgoing()
+        if data is None:
+            return
+        round_name = node.outgoing_round
+        targets = self.nodes[1:] if index == 0 else self.nodes[:1]
+        for target in targets:
+            target.handle_incoming(io.BytesIO(data))
+        self.record(round_name, len(data), len(targets), broadcast=index == 0)
+
+    def run(self, timeout: Optional[float] = None) -> Dict:
+        ids = [str(i) for i in range(len(self.nodes))]
+        start = time.perf_counter()
+        for i, node in enumerate(self.nodes):
+            node.handle_setup(ids[i], i == 0, ids)
+
+        while not all(node.status_finished for node in self.nodes):
+            for i, node in enumerate(self.nodes):
+                if node.status_available:
+                    self.relay(i, node)
+                elif not node.status_finished and not node.thread.is_alive():
+                    raise RuntimeError(f"Site {i} failed")
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError(f"The run did not finish within {timeout}s")
+            time.sleep(self.poll_interval)
+        elapsed = time.perf_counter() - start
+
+        for node in self.nodes:
+            node.thread.join()
+        return {
+            "sites": len(self.nodes),
+            "elapsed": elapsed,
+            "rounds": {round_name: {"latency": stats["end"] - stats["start"], "bytes_up": stats["bytes_up"],
+                                    "bytes_down": stats["bytes_down"], "messages": stats["messages"]}
+                       for round_name, stats in self.rounds.items()},
+            "coordinator": self.nodes[0].metrics.to_dict(),
+        }
+
+
+def write_site(directory: str, rows: int, categorical: int, cardinality: int, mode: str, seed: int):
+    input_dir = os.path.join(directory, "input")
+    output_dir = os.path.join(directory, "output")
+    os.makedirs(input_dir)
+    os.makedirs(output_dir)
+
+    table, levels = generate_table(rows, categorical, 2, cardinality, na_rate=0.01, seed=seed)
+    table.to_csv(os.path.join(input_dir, "data.csv"), index=False)
+    config = {"files": {"input_filename": "data.csv", "output_filename": "data_ohe.csv", "sep": ","}, "mode": mode}
+    if mode == "predefined":
+        config["categorical_variables"] = levels
+    with open(os.path.join(input_dir, "config.yml"), "w") as f:
+        yaml.dump({"fc_one_hot_encoding": config}, f)
+    return input_dir, output_dir
+
+
+def run(sites: int, rows: int, categorical: int, cardinality: int, mode: str, timeout: Optional[float] = None):
+    with tempfile.TemporaryDirectory() as tmp:
+        directories = [write_site(os.path.join(tmp, f"site{i}"), rows, categorical, cardinality, mode, seed=i)
+                       for i in range(sites)]
+        return LocalController(directories).run(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sites", type=int, nargs="+", default=[2, 10, 50])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--categorical", type=int, default=5)
+    parser.add_argument("--cardinality", type=int, default=20)
+    parser.add_argument("--mode", default="auto", choices=["auto", "predefined"])
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the sites")
+    args = parser.parse_args()
+
+    results = []
+    for sites in args.sites:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                logging.disable(logging.WARNING)
+            result = run(sites, args.rows, args.categorical, args.cardinality, args.mode, args.timeout)
+            logging.disable(logging.NOTSET)
+        results.append(result)
+
+        rounds = ", ".join(f"{round_name} {stats['latency'] * 1000:.1f}ms "
+                           f"({stats['bytes_up']} B up, {stats['bytes_down']} B down)"
+                           for round_name, stats in result["rounds"].items())
+        print(f"{sites:>4} sites: {result['elapsed']:.3f}s total; {rounds}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Import time of the control plane (the modules main.py needs to answer the controller) and of the data stack
+# that the app flow loads on its worker thread. Every measurement runs in a fresh interpreter.
+#
+# Usage: python -m benchmark.startup [--repeat N]
+import argparse
+import statistics
+import subprocess
+import sys
+
+CONTROL_PLANE = "import app.api_ctrl, app.api_web"
+DATA_STACK = "from app.logic import AppLogic; AppLogic.load_data_stack()"
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "scipy", "yaml"]
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+{statement}
+duration = time.perf_counter() - start
+print(duration, ",".join(name for name in {modules!r} if name in sys.modules))
+"""
+
+
+def measure(statement: str, repeat: int):
+    durations = []
+    modules = ""
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", SCRIPT.format(statement=statement, modules=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True).stdout.split()
+        durations.append(float(output[0]))
+        modules = output[1] if len(output) > 1 else ""
+    return statistics.median(durations), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'import':<16}{'median [s]':>12}  heavy modules loaded")
+    for label, statement in [("control plane", CONTROL_PLANE), ("data stack", DATA_STACK)]:
+        duration, modules = measure(statement, args.repeat)
+        print(f"{label:<16}{duration:>12.3f}  {modules or '-'}")
+
+
+if __name__ == '__main__':
+    main()
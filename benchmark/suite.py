@@ -0,0 +1,148 @@
+# Benchmark of the stages of a local encoding run on a synthetic table: reading the input, collecting the categories,
+# dropping rows with unknown categories, encoding, the NA check on the encoded table and writing the output.
+# Wall time, the tracemalloc peak of every stage and the peak RSS of the process after it are written as JSON.
+#
+# Usage: python -m benchmark.suite [--rows N] [--categorical N] [--numeric N] [--cardinality N] [--na-rate F]
+#                                  [--unknown-fraction F] [--output results.json]
+#                                  [--baseline baseline.json [--tolerance F]] [--save-baseline baseline.json]
+# With --baseline the exit code is 1 if a stage is slower or needs more memory than the baseline allows.
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+import pandas
+
+from app.algo import get_categories, drop_rows_with_unknown_categories, drop_rows_with_introduced_na_values
+from app.encode import encode_categorical, INDICATOR_DTYPES
+from app.formats import read_table, write_table
+from app.metrics import peak_rss
+from app.plan import EncodingPlan
+from benchmark.data import generate_table
+
+# absolute slack on top of the relative tolerance, so that stages that take only a few milliseconds or allocate
+# only a few kilobytes do not fail on noise
+MIN_TIME_SLACK = 0.05
+MIN_MEMORY_SLACK = 1 * 2 ** 20
+
+
+def measure(stages: List[Dict], name: str, func, *args, **kwargs):
+    # the stage runs twice: timed without tracing, since tracemalloc slows down allocations considerably, and
+    # once more under tracemalloc for its peak memory
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stages.append({"stage": name, "time": duration, "peak_memory": peak, "peak_rss": peak_rss()})
+    return result
+
+
+def run(rows: int, categorical: int, numeric: int, cardinality: int, na_rate: float, unknown_fraction: float,
+        dtype: str = "float64", output_format: str = "csv", seed: int = 0) -> Dict:
+    table, levels = generate_table(rows, categorical, numeric, cardinality, na_rate, unknown_fraction, seed)
+    plan = EncodingPlan(levels)
+    stages = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "input.csv")
+        table.to_csv(input_path, index=False)
+        del table
+
+        data = measure(stages, "read_data", read_table, input_path)
+        measure(stages, "get_categories", get_categories, data)
+        filtered, codes = measure(stages, "drop_rows_with_unknown_categories", drop_rows_with_unknown_categories,
+                                  data, plan)
+        measure(stages, "encode_categorical", encode_categorical, filtered, plan, dtype=INDICATOR_DTYPES[dtype],
+                codes=codes)
+        # the NA check runs on the unfiltered encoded table, as it did before unknown rows were dropped up front
+        encoded = encode_categorical(data, plan, dtype=INDICATOR_DTYPES[dtype])
+        encoded = measure(stages, "drop_rows_with_introduced_na_values", drop_rows_with_introduced_na_values,
+                          data, encoded)
+        measure(stages, "write_output", write_table, encoded, os.path.join(tmp, f"output.{output_format}"),
+                output_format)
+
+    return {
+        "parameters": {"rows": rows, "categorical": categorical, "numeric": numeric, "cardinality": cardinality,
+                       "na_rate": na_rate, "unknown_fraction": unknown_fraction, "dtype": dtype,
+                       "output_format": output_format, "seed": seed},
+        "environment": {"python": platform.python_version(), "pandas": pandas.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "stages": stages,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.25) -> List[str]:
+    # stages that regressed past the baseline by more than the tolerance, a stage missing in the baseline is ignored
+    baseline_stages = {stage["stage"]: stage for stage in baseline["stages"]}
+    regressions = []
+    for stage in results["stages"]:
+        reference = baseline_stages.get(stage["stage"])
+        if reference is None:
+            continue
+        time_limit = max(reference["time"] * (1 + tolerance), reference["time"] + MIN_TIME_SLACK)
+        if stage["time"] > time_limit:
+            regressions.append(f"{stage['stage']}: {stage['time']:.3f}s, baseline {reference['time']:.3f}s")
+        memory_limit = max(reference["peak_memory"] * (1 + tolerance), reference["peak_memory"] + MIN_MEMORY_SLACK)
+        if stage["peak_memory"] > memory_limit:
+            regressions.append(f"{stage['stage']}: peak memory {stage['peak_memory'] / 2 ** 20:.1f} MiB, "
+                               f"baseline {reference['peak_memory'] / 2 ** 20:.1f} MiB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--categorical", type=int, default=5)
+    parser.add_argument("--numeric", type=int, default=5)
+    parser.add_argument("--cardinality", type=int, default=50)
+    parser.add_argument("--na-rate", type=float, default=0.01)
+    parser.add_argument("--unknown-fraction", type=float, default=0.01)
+    parser.add_argument("--dtype", default="float64", choices=list(INDICATOR_DTYPES))
+    parser.add_argument("--output-format", default="csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="fail if a stage regressed compared to the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", help="store the results as baseline in this file")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.categorical, args.numeric, args.cardinality, args.na_rate, args.unknown_fraction,
+                  args.dtype, args.output_format, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    for stage in results["stages"]:
+        print(f"{stage['stage']:<36}{stage['time']:>8.3f}s{stage['peak_memory'] / 2 ** 20:>10.1f} MiB",
+              file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != results["parameters"]:
+            print("Warning: the baseline was recorded with different parameters", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ from bottle import Bottle
 
 from app.api_ctrl import api_server
 from app.api_web import web_server
+from app.server import ThreadedServer
 
 server = Bottle()
 
@@ -10,4 +11,4 @@ if __name__ == '__main__':
     print('Starting app', flush=True)
     server.mount('/api', api_server)
     server.mount('/web', web_server)
-    server.run(host='localhost', port=5000)
+    server.run(host='localhost', port=5000, server=ThreadedServer)
@@ -0,0 +1,12 @@
+from unittest import TestCase
+
+from app.api_ctrl import parse_wait, MAX_STATUS_WAIT
+
+
+class TestStatusWait(TestCase):
+    def test_parse_wait(self):
+        self.assertEqual(1.5, parse_wait("1.5"))
+        self.assertEqual(MAX_STATUS_WAIT, parse_wait(str(MAX_STATUS_WAIT * 10)))
+        # invalid and negative values do not wait
+        for value in ["abc", "", "-5", None]:
+            self.assertEqual(0, parse_wait(value))
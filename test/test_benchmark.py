@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from benchmark.data import generate_table
+from benchmark.federation import run
+from benchmark.suite import compare
+
+
+class TestBenchmark(TestCase):
+    def test_generate_table(self):
+        table, levels = generate_table(10000, n_categorical=2, n_numeric=3, cardinality=7, na_rate=0.1,
+                                       unknown_fraction=0.2)
+        self.assertListEqual(['cat0', 'cat1', 'num0', 'num1', 'num2'], list(table.columns))
+        self.assertEqual(7, len(levels['cat0']))
+        self.assertAlmostEqual(0.1, table['cat0'].isna().mean(), delta=0.02)
+        unknown = table['cat0'].notna() & ~table['cat0'].isin(levels['cat0'])
+        self.assertAlmostEqual(0.2 * 0.9, unknown.mean(), delta=0.02)
+
+    def test_compare(self):
+        baseline = {'stages': [{'stage': 'encode', 'time': 1.0, 'peak_memory': 100 * 2 ** 20}]}
+        faster = {'stages': [{'stage': 'encode', 'time': 0.5, 'peak_memory': 110 * 2 ** 20},
+                             {'stage': 'new', 'time': 9.0, 'peak_memory': 0}]}
+        slower = {'stages': [{'stage': 'encode', 'time': 1.5, 'peak_memory': 200 * 2 ** 20}]}
+        self.assertListEqual([], compare(faster, baseline))
+        self.assertEqual(2, len(compare(slower, baseline)))
+
+    def test_federation(self):
+        result = run(sites=3, rows=200, categorical=2, cardinality=5, mode="auto", timeout=60)
+        self.assertEqual(3, result['sites'])
+        self.assertListEqual(['mode', 'aggregation'], list(result['rounds']))
+        # both participants upload to the coordinator, which broadcasts to both of them
+        self.assertEqual(4, result['rounds']['aggregation']['messages'])
+        self.assertGreater(result['rounds']['aggregation']['bytes_down'], 0)
+        self.assertEqual(200, result['coordinator']['rows']['in'])
@@ -0,0 +1,55 @@
+import os
+import pickle
+import tempfile
+import time
+from unittest import TestCase
+
+import pandas
+
+from app.cache import SummaryCache, SUMMARY_FILENAME
+
+
+class TestSummaryCache(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, 'input.csv')
+        with open(self.input_path, 'w') as f:
+            f.write('a,b\n1,x\n')
+        self.cache = SummaryCache(os.path.join(self.directory.name, 'cache'), 2 ** 20)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_summary(self):
+        key = self.cache.get_key(self.input_path, sep=',')
+        self.assertIsNone(self.cache.get_summary(key))
+        self.cache.put_summary(key, ({'b': {'x'}}, set()))
+        self.assertEqual(({'b': {'x'}}, set()), self.cache.get_summary(key))
+
+        # entries that are not in the format of the cache, e.g. pickled by earlier versions, are ignored
+        with open(os.path.join(self.cache.directory, key, SUMMARY_FILENAME), 'wb') as f:
+            pickle.dump(({'b': {'x'}}, set()), f)
+        self.assertIsNone(self.cache.get_summary(key))
+
+        self.assertNotEqual(key, self.cache.get_key(self.input_path, sep=';'))
+        with open(self.input_path, 'a') as f:
+            f.write('2,y\n')
+        self.assertNotEqual(key, self.cache.get_key(self.input_path, sep=','))
+
+    def test_data(self):
+        key = self.cache.get_key(self.input_path)
+        table = pandas.DataFrame({'a': [1, 2], 'b': ['x', None]})
+        self.cache.put_data(key, table)
+        pandas.testing.assert_frame_equal(table, pandas.read_feather(self.cache.get_data_path(key)))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.max_size = 1500
+        for key in ['a', 'b', 'c']:
+            # incompressible, so that every entry takes 600 bytes
+            self.cache.put_summary(key, os.urandom(600))
+            time.sleep(0.01)
+            if key == 'b':
+                self.cache.get_summary('a')
+        self.assertIsNotNone(self.cache.get_summary('a'))
+        self.assertIsNone(self.cache.get_summary('b'))
+        self.assertIsNotNone(self.cache.get_summary('c'))
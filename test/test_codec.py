@@ -0,0 +1,42 @@
+from collections import defaultdict
+from unittest import TestCase
+
+import numpy
+
+from app import codec
+
+
+class TestCodec(TestCase):
+    def test_round_trip(self):
+        levels = defaultdict(set)
+        levels['a'].update({0, 1, 2})
+        levels['b'].update({'low', 'high', 'mid'})
+        levels['c'].update({'1', 1, -7, 2 ** 70})
+        for value in [None, True, 'auto', 'plan:abc', levels, {'a': ['x', 'y'], 'b': (1.5, None)}, {'x': b'\x00'}]:
+            self.assertEqual(value, codec.loads(codec.dumps(value)))
+            self.assertEqual(value, codec.loads(codec.dumps(value, compress=False)))
+
+    def test_types_survive(self):
+        decoded = codec.loads(codec.dumps({'a': {1, '1'}, 'b': [numpy.int64(3), numpy.bool_(True), 0.5]}))
+        self.assertSetEqual({1, '1'}, decoded['a'])
+        self.assertListEqual([int, bool, float], [type(value) for value in decoded['b']])
+
+    def test_strings_are_deduplicated(self):
+        levels = {f'column{i}': {f'level{j}' for j in range(100)} for i in range(10)}
+        self.assertLess(len(codec.dumps(levels, compress=False)), len(repr(levels)) / 2)
+
+    def test_invalid_payload(self):
+        with self.assertRaises(ValueError):
+            codec.loads(b'{"py/set": []}')
+        with self.assertRaises(ValueError):
+            codec.loads(codec.MAGIC + bytes([codec.VERSION + 1, 0]))
+
+    def test_truncated_payload(self):
+        levels = {'a': {'x', 'y'}, 'b': [1.5, b'\x00' * 10]}
+        for compress in [False, True]:
+            payload = codec.dumps(levels, compress=compress)
+            for end in range(len(payload)):
+                with self.assertRaises(ValueError):
+                    codec.loads(payload[:end])
+            with self.assertRaises(ValueError):
+                codec.loads(payload + b'\x00')
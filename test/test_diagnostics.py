@@ -0,0 +1,24 @@
+import logging
+from unittest import TestCase
+
+import pandas
+
+from app.diagnostics import Lazy, preview
+
+
+class TestDiagnostics(TestCase):
+    def test_preview_is_capped(self):
+        self.assertEqual("{'a': [0, 1, ... (98 more)]}", preview({'a': list(range(100))}, items=2))
+        self.assertEqual("'xxxxx... (96 more characters)", preview('x' * 100, chars=6))
+        text = preview(pandas.DataFrame({'a': range(1000)}), items=3)
+        self.assertTrue(text.startswith('DataFrame of shape (1000, 1)'))
+        self.assertEqual(5, len(text.splitlines()))
+
+    def test_lazy_is_only_evaluated_if_enabled(self):
+        calls = []
+        logger = logging.getLogger('test_diagnostics')
+        logger.setLevel(logging.INFO)
+        with self.assertLogs(logger, logging.INFO):
+            logger.debug('%s', Lazy(calls.append, 'debug'))
+            logger.info('%s', Lazy(calls.append, 'info'))
+        self.assertListEqual(['info'], calls)
@@ -1,10 +1,18 @@
+import os
+import pickle
+import tempfile
+import tracemalloc
 from unittest import TestCase
 
+import numpy
 import pandas
 import pandas as pd
 
-from app.algo import get_categories, set_as_categorical, drop_rows_with_introduced_na_values
-from app.encode import encode_categorical, get_columns_to_encode
+from app import codec
+from app.algo import get_categories, set_as_categorical, drop_rows_with_introduced_na_values, \
+    drop_rows_with_unknown_categories, get_category_counts, IncrementalCombiner, CategoryDiscovery
+from app.encode import encode_categorical, get_columns_to_encode, encode_ordinal, decode_categorical, decode_ordinal
+from app.plan import EncodingPlan, PLAN_FILENAME, PLAN_VERSION, OTHER_LEVEL
 
 
 class TestEncodeCategorical(TestCase):
@@ -52,3 +60,182 @@ class TestEncodeCategorical(TestCase):
         columns_to_encode = get_columns_to_encode(self.df)
         self.assertSetEqual({'a', 'b'}, columns_to_encode)
         self.assertDictEqual({'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}}, get_categories(self.df))
+
+    def test_sparse_matches_dense(self):
+        levels = {'a': {0, 2}, 'b': {'low', 'high'}}
+        dense = encode_categorical(self.df, levels)
+        sparse = encode_categorical(self.df, levels, sparse=True)
+        self.assertListEqual(list(dense.columns.values), list(sparse.columns.values))
+        self.assertIsInstance(sparse['a=2'].dtype, pandas.SparseDtype)
+        for name in ['a=2', 'b=low']:
+            pandas.testing.assert_series_equal(dense[name], sparse[name].sparse.to_dense())
+
+    def test_compact_dtype_with_validity_mask(self):
+        df = pandas.DataFrame(
+            {
+                'a': [0, 1, 2, 0, pd.NA],
+                'b': ['high', 'low', 'mid', 'low', 'low'],
+                'c': [pd.NA, 12.5, 0.25, -0.35, 3.10],
+            }
+        )
+        encoded, valid_rows = encode_categorical(df, {'a': {0, 2}, 'b': {'low', 'high'}}, dtype=numpy.uint8,
+                                                 return_valid_rows=True)
+        self.assertListEqual([True, False, False, True, True], list(valid_rows))
+        self.assertEqual(numpy.uint8, encoded['b=low'].dtype)
+        self.assertEqual(0, encoded['b=low'].iloc[2])  # unknown category 'mid' is all-zero
+
+        filtered = drop_rows_with_introduced_na_values(df, encoded, valid_rows)
+        self.assertListEqual([0, 3, 4], list(filtered.index.values))
+        self.assertTrue(filtered.isna()['a=2'].iloc[2])
+        self.assertListEqual([0, 0], list(filtered['a=2'].iloc[:2]))
+
+    def test_drop_rows_with_unknown_categories(self):
+        df = pandas.DataFrame(
+            {
+                'a': [0, 1, 2, 0, pd.NA],
+                'b': ['high', 'low', 'mid', 'low', 'low'],
+                'c': [pd.NA, 12.5, 0.25, -0.35, 3.10],
+            }
+        )
+        levels = {'a': {0, 2}, 'b': {'low', 'high'}}  # category 1 and high are missing
+        filtered, codes = drop_rows_with_unknown_categories(df, levels)
+        self.assertListEqual([0, 3, 4], list(filtered.index.values))
+        self.assertListEqual([0, 0, -1], list(codes['a']))
+
+        encoded = encode_categorical(filtered, levels, codes=codes)
+        expected = drop_rows_with_introduced_na_values(df, encode_categorical(df, levels))
+        pandas.testing.assert_frame_equal(expected, encoded)
+
+    def test_single_level_column_keeps_unknown_values(self):
+        # a column with a single level is passed through by the one-hot encoding, so its values never drop a row
+        df = pandas.DataFrame({'s': ['only', 'other', 'only'], 'b': ['low', 'high', 'x']})
+        levels = {'s': {'only'}, 'b': {'low', 'high'}}
+        filtered, codes = drop_rows_with_unknown_categories(df, levels)
+        self.assertListEqual([0, 1], list(filtered.index.values))
+        encoded, valid_rows = encode_categorical(df, levels, return_valid_rows=True)
+        self.assertListEqual([True, True, False], valid_rows.tolist())
+        self.assertListEqual(['only', 'other', 'only'], encoded['s'].tolist())
+
+        # the ordinal encoding has no value for it
+        filtered, codes = drop_rows_with_unknown_categories(df, levels, ordinal=True)
+        self.assertListEqual([0], list(filtered.index.values))
+
+    def test_assembly_does_not_copy_the_output(self):
+        # the indicator columns are written into one buffer that becomes the output, the peak memory of the encoding
+        # is the size of the output plus a constant
+        rng = numpy.random.default_rng(0)
+        levels = {name: {f'v{i}' for i in range(40)} for name in ['a', 'b', 'c']}
+        df = pandas.DataFrame({name: rng.choice(sorted(values), 50000) for name, values in levels.items()})
+        df['n'] = numpy.arange(50000.0)
+
+        tracemalloc.start()
+        try:
+            encoded = encode_categorical(df, levels)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(['a=v1', 'a=v10', 'a=v11'], list(encoded.columns[:3]))
+        self.assertLess(peak, encoded.memory_usage(index=False).sum() + 8 * 2 ** 20)
+
+    def test_parallel_matches_serial(self):
+        levels = {'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}}
+        self.df['a'] = self.df['a'].astype(object)
+        serial = encode_categorical(self.df, levels)
+        parallel = encode_categorical(self.df, levels, workers=4)
+        pandas.testing.assert_frame_equal(serial, parallel)
+        self.assertEqual(serial.to_csv(index=False), parallel.to_csv(index=False))
+
+    def test_encoding_plan(self):
+        levels = {'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}}
+        plan = EncodingPlan(levels)
+        self.assertListEqual(['b=low', 'b=mid'], plan.names['b'])
+        self.assertDictEqual({'a': 0, 'b': 2}, plan.offsets(['a', 'c', 'b']))
+
+        capped = EncodingPlan({'b': {'low', 'high', OTHER_LEVEL}})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, PLAN_FILENAME)
+            plan.save(path)
+            loaded = EncodingPlan.load(path)
+            capped.save(path)
+            loaded_capped = EncodingPlan.load(path)
+
+            # only the levels are stored, damaged plans, pickles and other versions are rejected
+            with open(path, "rb") as f:
+                payload = f.read()
+            with open(path, "wb") as f:
+                f.write(payload[:-3])
+            with self.assertRaises(ValueError):
+                EncodingPlan.load(path)
+            with open(path, "wb") as f:
+                pickle.dump(plan, f)
+            with self.assertRaises(ValueError):
+                EncodingPlan.load(path)
+            with open(path, "wb") as f:
+                f.write(codec.dumps({"version": PLAN_VERSION + 1, "levels": plan.levels}))
+            with self.assertRaises(ValueError):
+                EncodingPlan.load(path)
+        self.assertEqual(plan.fingerprint, loaded.fingerprint)
+        self.assertListEqual([0, 1, 2], loaded.levels['a'])
+        pandas.testing.assert_frame_equal(encode_categorical(self.df, levels), encode_categorical(self.df, loaded))
+        self.assertDictEqual(capped.other_codes, loaded_capped.other_codes)
+
+    def test_cardinality_cap(self):
+        df = pandas.DataFrame({'b': ['x', 'y', 'y', 'z', 'z', 'z', 'w', None], 'id': [str(i) for i in range(8)]})
+        combiner = IncrementalCombiner()
+        combiner.add(get_category_counts(df))
+        combiner.add({'b': {'y': 2}})
+        levels = combiner.result(max_levels=2, max_cardinality=5)
+        self.assertNotIn('id', levels)
+        self.assertSetEqual({'y', 'z', OTHER_LEVEL}, levels['b'])
+
+        plan = EncodingPlan(levels)
+        self.assertListEqual(['y', 'z', OTHER_LEVEL], plan.levels['b'])
+        encoded, valid_rows = encode_categorical(df, plan, return_valid_rows=True)
+        self.assertListEqual(['b=z', 'b=__other__', 'id'], list(encoded.columns))
+        self.assertTrue(valid_rows.all())
+        self.assertListEqual([1, 0, 0, 0, 0, 0, 1], encoded['b=__other__'][:7].tolist())
+        self.assertTrue(encoded.iloc[7, :2].isna().all())
+
+    def test_category_discovery(self):
+        df = pandas.DataFrame({'b': ['x', 'y', None, 'z', 'y', 'x'], 'id': [str(i) for i in range(6)], 'c': range(6)})
+        discovery = CategoryDiscovery(max_cardinality=4)
+        for start in range(0, len(df), 2):
+            self.assertSetEqual({'b', 'id'}, discovery.update(df[start:start + 2]))
+        self.assertSetEqual({'id'}, discovery.exceeded)
+        self.assertDictEqual({'b': 3, 'id': 5}, discovery.distinct_counts())
+        self.assertSetEqual({'x', 'y', 'z'}, discovery.result()['b'])
+
+        discovery = CategoryDiscovery(counts=True)
+        discovery.update(df[:3])
+        discovery.update(df[3:])
+        self.assertDictEqual(get_category_counts(df), discovery.result())
+
+    def test_decode_round_trip(self):
+        df = pandas.DataFrame({'a': [0, 1, 2, 0], 'b': ['high', 'low', None, 'mid'], 'c': [2.85, 12.5, 0.25, -0.35]})
+        plan = EncodingPlan({'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}})
+        encoded = [encode_categorical(df, plan), encode_categorical(df, plan, dtype=numpy.uint8),
+                   encode_categorical(df, plan, sparse=True)]
+        for table in encoded:
+            decoded = decode_categorical(table, plan, workers=2)
+            self.assertListEqual(['a', 'b', 'c'], list(decoded.columns))
+            self.assertEqual('category', decoded['b'].dtype)
+            pandas.testing.assert_frame_equal(df, decoded.astype({'a': 'int64', 'b': object}))
+
+        pandas.testing.assert_frame_equal(decode_ordinal(encode_ordinal(df, plan), plan),
+                                          decode_categorical(encoded[0], plan))
+        with self.assertRaises(ValueError):
+            decode_categorical(encoded[0].drop(columns=['b=mid']), plan)
+
+    def test_ordinal(self):
+        df = pandas.DataFrame({'a': [0, 1, 2, 0], 'b': ['high', 'low', None, 'x'], 'c': [1.5, 2.5, 3.5, 4.5]})
+        levels = {'a': {0, 1, 2}, 'b': {'high', 'low', 'mid'}}
+        data, codes = drop_rows_with_unknown_categories(df, levels)
+        encoded = encode_ordinal(data, levels, codes=codes)
+        self.assertListEqual(['a', 'b', 'c'], list(encoded.columns))
+        self.assertEqual(numpy.int8, encoded['a'].dtype)
+        self.assertEqual('Int8', encoded['b'].dtype)
+        self.assertListEqual([0, 1, 2], encoded['a'].tolist())
+        self.assertListEqual([0, 1, pandas.NA], encoded['b'].tolist())
+
+        _, valid_rows = encode_ordinal(df, levels, return_valid_rows=True)
+        self.assertListEqual([True, True, True, False], valid_rows.tolist())
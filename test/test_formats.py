@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+import numpy
+import pandas
+
+from app.encode import encode_categorical
+from app.formats import TableWriter, get_manifest_path, write_table, read_table, iter_table, get_input_format
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestTableWriter(TestCase):
+    def setUp(self) -> None:
+        self.df = pandas.DataFrame(
+            {
+                'a': [0, 1, 2, 0],
+                'b': ['high', 'low', 'mid', 'low'],
+                'c': [2.85, 12.5, 0.25, -0.35],
+            }
+        )
+        self.encoded = encode_categorical(self.df, {'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}}, dtype=numpy.uint8)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_csv_in_chunks(self):
+        path = os.path.join(self.directory.name, 'out.csv')
+        with TableWriter(path, 'csv') as writer:
+            writer.write(self.encoded.iloc[:1])
+            writer.write(self.encoded.iloc[1:])
+        self.assertEqual(self.encoded.to_csv(index=False), open(path).read())
+
+    def test_sparse_csv_matches_dense(self):
+        df = pandas.DataFrame({'a': [0, 1, 2, None], 'b': ['high', 'low', 'mid', 'low'], 'c': [1.5, 2, 3, 4]})
+        levels = {'a': {0, 1, 2}, 'b': {'low', 'high', 'mid'}}
+        # compact sparse columns with missing values are float, not nullable, so a is only encoded as float
+        for dtype, table in [(numpy.float64, df), (numpy.uint8, df[['b', 'c']])]:
+            outputs = []
+            for sparse in [False, True]:
+                encoded = encode_categorical(table, levels, sparse=sparse, dtype=dtype)
+                path = os.path.join(self.directory.name, f'out_{sparse}.csv')
+                with TableWriter(path, 'csv') as writer:
+                    writer.write(encoded.iloc[:1])
+                    writer.write(encoded.iloc[1:])
+                with open(path, 'rb') as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_fast_csv(self):
+        df = pandas.DataFrame({'a': [0, 1, 2, None], 'b': ['hi, "x"', 'low', 'new\nline', 'low'], 'c': [1.5, 2, 3, 4],
+                           'd': ['x', 'y\nz', 'u', 'v']})
+        levels = {'a': {0, 1, 2}, 'b': {'low', 'hi, "x"', 'new\nline'}}
+        encoded = encode_categorical(df, levels)
+        indicator_columns = ['a=1', 'a=2', 'b=low', 'b=new\nline']
+        for name in ['out.csv', 'out.csv.gz']:
+            path = os.path.join(self.directory.name, name)
+            with TableWriter(path, 'csv', csv_writer='fast', indicator_columns=indicator_columns) as writer:
+                writer.write(encoded.iloc[:2])
+                writer.write(encoded.iloc[2:])
+            pandas.testing.assert_frame_equal(encoded, pandas.read_csv(path), check_dtype=False)
+
+        path = os.path.join(self.directory.name, 'out.csv')
+        write_table(self.encoded, path, csv_writer='fast', indicator_columns=['a=1', 'a=2', 'b=low', 'b=mid'])
+        self.assertEqual(self.encoded.to_csv(index=False), open(path).read())
+
+    def test_npy_with_manifest(self):
+        path = os.path.join(self.directory.name, 'out.npy')
+        with TableWriter(path, 'npy') as writer:
+            writer.write(self.encoded.iloc[:3])
+            writer.write(self.encoded.iloc[3:])
+
+        values = numpy.load(path, mmap_mode='r')
+        manifest = json.load(open(get_manifest_path(path)))
+        self.assertListEqual(list(self.encoded.columns), manifest['columns'])
+        numpy.testing.assert_array_equal(self.encoded.to_numpy(dtype=numpy.float64), values)
+
+    def test_npy_promotes_dtype(self):
+        # int and uint8 columns in the first chunk, a missing value and a fractional value in the second one
+        path = os.path.join(self.directory.name, 'out.npy')
+        with TableWriter(path, 'npy', dtypes={'x=1': numpy.uint8}) as writer:
+            writer.write(pandas.DataFrame({'x=1': numpy.array([0, 1], dtype=numpy.uint8), 'i': [1, 2]}))
+            writer.write(pandas.DataFrame({'x=1': pandas.array([1, None], dtype='UInt8'), 'i': [3.5, numpy.nan]}))
+        numpy.testing.assert_array_equal(numpy.array([[0, 1], [1, 2], [1, 3.5], [numpy.nan, numpy.nan]]),
+                                         numpy.load(path))
+        self.assertEqual('float64', json.load(open(get_manifest_path(path)))['dtype'])
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_arrow_fails_on_type_change(self):
+        path = os.path.join(self.directory.name, 'out.parquet')
+        with TableWriter(path, 'parquet', dtypes={'x=1': numpy.uint8}) as writer:
+            writer.write(pandas.DataFrame({'x=1': [0.0, 1.0], 'i': [1, 2]}))
+            # missing indicators fit the declared type, a fractional value does not fit the int column
+            writer.write(pandas.DataFrame({'x=1': [numpy.nan, 1.0], 'i': [3, 4]}))
+            with self.assertRaises(ValueError):
+                writer.write(pandas.DataFrame({'x=1': [0.0, 1.0], 'i': [5.5, 6.0]}))
+        from pyarrow import parquet
+        self.assertEqual(pyarrow.uint8(), parquet.read_schema(path).field('x=1').type)
+
+    def test_npy_requires_numeric_columns(self):
+        with self.assertRaises(ValueError):
+            write_table(self.df, os.path.join(self.directory.name, 'out.npy'), 'npy')
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_parquet_keeps_dtypes(self):
+        path = os.path.join(self.directory.name, 'out.parquet')
+        write_table(self.encoded, path, 'parquet')
+        pandas.testing.assert_frame_equal(self.encoded, pandas.read_parquet(path))
+
+    def test_read_csv_with_categorical_columns(self):
+        path = os.path.join(self.directory.name, 'in.csv')
+        self.df.to_csv(path, index=False)
+        table = read_table(path, get_input_format(path), columns=['a', 'b'], categorical_columns=['b'])
+        self.assertListEqual(['a', 'b'], list(table.columns))
+        self.assertIsInstance(table['b'].dtype, pandas.CategoricalDtype)
+
+        chunks = list(iter_table(path, 3, get_input_format(path)))
+        self.assertListEqual([3, 1], [len(chunk) for chunk in chunks])
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_read_parquet_in_chunks(self):
+        path = os.path.join(self.directory.name, 'in.parquet')
+        self.df.to_parquet(path)
+        self.assertEqual('parquet', get_input_format(path))
+        pandas.testing.assert_frame_equal(self.df, read_table(path, 'parquet'))
+
+        chunks = list(iter_table(path, 3, 'parquet', columns=['b'], categorical_columns=['b']))
+        self.assertListEqual([3, 1], [len(chunk) for chunk in chunks])
+        self.assertIsInstance(chunks[0]['b'].dtype, pandas.CategoricalDtype)
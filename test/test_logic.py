@@ -0,0 +1,141 @@
+import io
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+import numpy
+
+from app import codec
+from app.cache import SummaryCache
+from app.logic import AppLogic, SPOOL_MAX_SIZE
+
+
+class TestInputFiles(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        for name in ['fold1.csv', 'fold0.csv', 'other.txt']:
+            open(os.path.join(self.directory.name, name), 'w').close()
+        self.logic = AppLogic(input_dir=self.directory.name)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_resolve_input_filenames(self):
+        self.assertListEqual(['data.csv'], self.logic.resolve_input_filenames('data.csv'))
+        self.assertListEqual(['b.csv', 'a.csv'], self.logic.resolve_input_filenames(['b.csv', 'a.csv']))
+        self.assertListEqual(['fold0.csv', 'fold1.csv'], self.logic.resolve_input_filenames('fold*.csv'))
+        with self.assertRaises(ValueError):
+            self.logic.resolve_input_filenames('missing*.csv')
+
+    def test_output_filename_pattern(self):
+        self.logic.output_filename = '{stem}_ohe.parquet'
+        self.assertEqual('fold0_ohe.parquet', self.logic.get_output_filename('splits/fold0.csv'))
+        self.logic.output_filename = 'encoded_{name}'
+        self.assertEqual('encoded_fold0.csv', self.logic.get_output_filename('fold0.csv'))
+
+
+class TestStreaming(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.logic = AppLogic(input_dir=self.directory.name)
+        self.logic.sep = ','
+        self.logic.chunksize = 2
+        self.logic.mode = 'auto'
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_rescan_mixed_columns(self):
+        # m is parsed as int in the first chunk and as string in the second one
+        with open(os.path.join(self.directory.name, 'data.csv'), 'w') as f:
+            f.write('m,b\n1,low\n2,high\nx,low\n')
+        summary = self.logic.summarize_file('data.csv')
+        self.assertSetEqual({'m'}, self.logic.mixed_columns['data.csv'])
+        self.assertDictEqual({'m': {'1', '2', 'x'}, 'b': {'low', 'high'}}, summary)
+
+    def test_column_dtypes_over_all_chunks(self):
+        with open(os.path.join(self.directory.name, 'data.csv'), 'w') as f:
+            f.write('i,f,b\n1,1,low\n2,2,high\n,3.5,low\n')
+        self.logic.summarize_file('data.csv')
+        self.assertDictEqual({'i': numpy.float64, 'f': numpy.float64}, self.logic.column_dtypes['data.csv'])
+        self.logic.output_format = 'parquet'
+        self.logic.column_dtypes.clear()
+        self.assertDictEqual({'i': numpy.float64, 'f': numpy.float64, 'b': object},
+                             self.logic.get_column_dtypes('data.csv'))
+
+
+class TestCache(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, 'data.csv'), 'w') as f:
+            f.write('b,n\n1,x\n2,y\n3,x\n')
+        self.logic = AppLogic(input_dir=self.directory.name)
+        self.logic.sep = ','
+        self.logic.cache = SummaryCache(os.path.join(self.directory.name, 'cache'), 2 ** 20)
+        self.logic.cache_data = True
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_cached_data_depends_on_categorical_columns(self):
+        # b is read as category with the string levels of the study definition, but as int without them
+        self.logic.mode = 'predefined'
+        self.logic.study_definition = {'b': ['1', '2', '3']}
+        self.assertEqual('category', self.logic.read_data('data.csv')['b'].dtype)
+        self.logic.mode = 'auto'
+        self.logic.study_definition = None
+        self.assertEqual(numpy.int64, self.logic.read_data('data.csv')['b'].dtype)
+
+    def test_cached_summary_keeps_column_dtypes(self):
+        # i only has a missing value in the last chunk, all chunks are written as float
+        with open(os.path.join(self.directory.name, 'data.csv'), 'w') as f:
+            f.write('i,b\n1,x\n2,y\n,x\n')
+        self.logic.mode = 'auto'
+        self.logic.chunksize = 2
+        summary = self.logic.summarize_file('data.csv')
+
+        logic = AppLogic(input_dir=self.directory.name)
+        logic.sep = ','
+        logic.mode = 'auto'
+        logic.chunksize = 2
+        logic.cache = self.logic.cache
+        self.assertDictEqual(summary, logic.summarize_file('data.csv'))
+        self.assertDictEqual({'i': numpy.float64}, logic.column_dtypes['data.csv'])
+
+
+class TestCommunication(TestCase):
+    def setUp(self) -> None:
+        self.logic = AppLogic()
+
+    def test_wait_for_status(self):
+        self.assertTupleEqual((False, False), self.logic.wait_for_status(False, False, timeout=0.01))
+        threading.Timer(0.05, self.logic.send, [b'data']).start()
+        self.assertTupleEqual((True, False), self.logic.wait_for_status(False, False, timeout=10))
+        self.assertEqual(b'data', self.logic.handle_outgoing())
+        self.assertTupleEqual((False, False), self.logic.wait_for_status(True, False, timeout=10))
+
+    def test_agreed_mode_includes_caps(self):
+        self.logic.mode = 'auto'
+        self.assertEqual('auto', self.logic.get_agreed_mode())
+        capped = AppLogic()
+        capped.mode = 'auto'
+        capped.max_cardinality = 100
+        self.assertFalse(AppLogic.check_agree([self.logic.get_agreed_mode(), capped.get_agreed_mode()]))
+        self.logic.max_cardinality = 100
+        self.assertTrue(AppLogic.check_agree([self.logic.get_agreed_mode(), capped.get_agreed_mode()]))
+
+    def test_outgoing_without_data(self):
+        self.assertIsNone(self.logic.handle_outgoing())
+        self.assertDictEqual({}, self.logic.metrics.traffic)
+
+    def test_incoming_payloads_are_spooled(self):
+        data = {'col': set(map(str, range(200000)))}
+        payload = codec.dumps(data, compress=False)
+        self.assertGreater(len(payload), SPOOL_MAX_SIZE)
+        self.logic.handle_incoming(io.BytesIO(payload))
+        self.assertEqual(1, self.logic.count_incoming())
+        spooled = self.logic.take_incoming()[0]
+        self.assertIsNot(bytes, type(spooled))
+        self.assertDictEqual(data, self.logic.decode_payload(spooled))
+        self.assertEqual(len(payload), self.logic.metrics.traffic['mode']['received'])
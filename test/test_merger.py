@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from app import codec
+from app.algo import combine
+from app.merger import BackgroundMerger
+
+
+class TestMerger(TestCase):
+    def test_matches_combine(self):
+        summaries = [{'a': {'x', 'y'}, 'b': {1}}, None, {'a': {'z'}, 'c': {'u', 'v'}}]
+        merger = BackgroundMerger(codec.loads)
+        merger.add(summaries[0])
+        for summary in summaries[1:]:
+            merger.submit(codec.dumps(summary))
+        self.assertDictEqual(dict(combine(summaries)), dict(merger.finalize()))
+        self.assertEqual(3, merger.processed)
+
+    def test_error_is_raised_on_finalize(self):
+        merger = BackgroundMerger(codec.loads)
+        merger.submit(b'invalid')
+        with self.assertRaises(ValueError):
+            merger.finalize()
+        self.assertEqual(1, merger.processed)
@@ -0,0 +1,33 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from app.metrics import Metrics
+
+
+class TestMetrics(TestCase):
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.enter_state('read')
+        for _ in range(2):
+            with metrics.stage('parse'):
+                pass
+        metrics.add_rows(10, 7)
+        metrics.add_traffic('mode', sent=5)
+        metrics.add_traffic('mode', received=3)
+        metrics.enter_state('write')
+
+        summary = metrics.to_dict()
+        self.assertListEqual(['read', 'write'], list(summary['state_durations']))
+        self.assertIn('read', summary['state_peak_rss'])
+        self.assertListEqual(['parse'], list(summary['stage_durations']))
+        self.assertDictEqual({'in': 10, 'out': 7, 'dropped': 3}, summary['rows'])
+        self.assertDictEqual({'mode': {'sent': 5, 'received': 3}}, summary['traffic'])
+        self.assertGreater(summary['peak_rss'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'summary.json')
+            metrics.save(path)
+            with open(path) as f:
+                self.assertDictEqual(summary['rows'], json.load(f)['rows'])
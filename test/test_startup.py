@@ -0,0 +1,13 @@
+import subprocess
+import sys
+from unittest import TestCase
+
+
+class TestStartup(TestCase):
+    def test_control_plane_does_not_import_data_stack(self):
+        # runs in a fresh interpreter, the test process has imported pandas already
+        output = subprocess.run(
+            [sys.executable, "-c", "import sys, app.api_ctrl, app.api_web; "
+                                   "print([name for name in ['numpy', 'pandas', 'yaml'] if name in sys.modules])"],
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual("[]", output.strip())